@@ -1,7 +1,7 @@
 from flask import Blueprint
 from flask_restful import Resource, abort
 
-from API.common import resp, get_franchise_id_by_object_id, is_with_agent
+from API.common import resp, is_with_agent
 from API.parsing_life_pay import *
 from DB import withSession, DbName, rawRequest
 from Logger import get_logger
@@ -9,7 +9,8 @@ from Logger import get_logger
 from Services import LifePayService
 from Services.LifePay import ReceiptContext, FranchiseReceipt, ContractorReceipt, NotNominalReceipt
 from MainApp import WithCurrentUser
-from Services.common import check_legal, is_nominal_object
+from Services.common import check_legal
+from Services.directory import merchant_resolver
 
 api_services_bp = Blueprint('life_pay_service', __name__)
 
@@ -41,8 +42,7 @@ class LifePayBills(Resource):
             return abort(409, message={f"Невозможно создать чек для {category}"})
         if category in ('franchise', 'foreman', 'foreman_cash_prepayment'):
             object_id = kwargs.get('object_id')
-            if not is_nominal_object(ses, object_id):
-                merchant_id = get_franchise_id_by_object_id(ses, object_id)
+            merchant_id = merchant_resolver.resolve_object(ses, object_id).merchant_id
         with_agent = True
 
         if category in ('foreman', 'foreman_cash_prepayment', 'franchise'):
@@ -10,12 +10,15 @@ from sqlalchemy import func
 
 from Config import configs
 from API.common import get_franchise_id_by_object_id, resp, plain_resp, get_franchise_id_by_cert_code
+from API.tasks import send_payment_email_task
 from DB import DbName, withSession
+from DB.loading import query_profile
 from API.parsing_yookassa import *
-from DB.models import ObjectBudget, CertificateVersion, Report, AmoObjects, EstimateObjects, Budgets, Clients, \
-    Object_x_Client, getData, Transactions
+from DB.models import ObjectBudget, CertificateVersion, Report, Budgets, Clients, Object_x_Client, getData, \
+    Transactions, EstimateObjects
 from Logger import get_logger
-from Services.common import Entity, uuid, ServiceError, PaymentMethod, TransactionTypeCode, is_nominal_object
+from Services.common import Entity, uuid, ServiceError, PaymentMethod, TransactionTypeCode
+from Services.directory import merchant_resolver
 from Services.Yookassa import Service as YookassaService
 
 api_services_bp = Blueprint('yookassa_services',
@@ -97,6 +100,11 @@ class YookassaPayments(Resource):
                              franchise_id=franchise_id))
         ses.commit()
 
+        if args.email:
+            # письмо отправляет воркер Celery, запрос не ждёт SMTP
+            send_payment_email_task.delay({'orderId': transaction_id, 'amount': args['amount'], 'url': order_url},
+                                          args.email)
+
         data = {
             "url": order_url,
             "orderNumber": transaction_id,
@@ -117,9 +125,9 @@ class YookassaPayments(Resource):
         data = None
 
         if orderId := args.orderId:
-            trs = ses.query(Transactions).filter_by(acquiring_order_id=orderId).one_or_none()
+            trs = query_profile(ses, Transactions, 'bare').filter_by(acquiring_order_id=orderId).one_or_none()
         elif orderNumber := args.orderNumber:
-            trs = ses.query(Transactions).filter_by(transaction_id=orderNumber).one_or_none()
+            trs = query_profile(ses, Transactions, 'bare').filter_by(transaction_id=orderNumber).one_or_none()
         else:
             trs = None
             abort(400, message={'message': 'Не указан ни один идентификатор'})
@@ -143,15 +151,10 @@ class YookassaPayments(Resource):
         :param order_number: номер заказа
         :return:
         """
-        sq = ses.query(EstimateObjects.is_nominal,
-                       AmoObjects.franchise_id). \
-            select_from(Transactions). \
-            filter(Transactions.transaction_id == order_number). \
-            join(EstimateObjects, EstimateObjects.object_id == Transactions.object_id). \
-            join(AmoObjects, AmoObjects.objects_id == Transactions.object_id).one_or_none()
-        if not sq or sq.is_nominal:
+        object_id = ses.query(Transactions.object_id).filter(Transactions.transaction_id == order_number).scalar()
+        if object_id is None:
             return None
-        return sq.franchise_id
+        return merchant_resolver.resolve_object(ses, object_id).merchant_id
 
     @staticmethod
     def _srv(user_id: int, merchant_id: int = None) -> YookassaService:
@@ -212,8 +215,6 @@ class YookassaPaymentLinks(Resource):
             res = ses.query(ObjectBudget.object_id,
                             func.to_char(CertificateVersion.updated_date, "DD.MM.YYYY").label("cert_date"),
                             Report.certificate_num,
-                            AmoObjects.franchise_id,
-                            EstimateObjects.is_nominal,
                             func.to_char(Budgets.contract_date, "DD.MM.YYYY").label("contract_date"),
                             func.concat(Clients.second_name, ' ',
                                         Clients.first_name, ' ',
@@ -223,13 +224,13 @@ class YookassaPaymentLinks(Resource):
                 join(CertificateVersion, CertificateVersion.certificate_code == Report.certificate_code). \
                 join(Object_x_Client, Object_x_Client.object_id == ObjectBudget.object_id, isouter=True). \
                 join(Clients, Clients.client_id == Object_x_Client.client_id, isouter=True). \
-                join(AmoObjects, AmoObjects.objects_id == ObjectBudget.object_id, isouter=True). \
                 join(EstimateObjects, EstimateObjects.object_id == ObjectBudget.object_id). \
                 filter(Report.certificate_code == entity_id). \
                 one_or_none()
 
-            if not res.is_nominal:
-                merchant_id = res.franchise_id
+            merchant = merchant_resolver.resolve_object(ses, res.object_id)
+            if not merchant.is_nominal:
+                merchant_id = merchant.franchise_id
                 if not merchant_id:
                     abort(400, message={'message': f'На объекте {res.object_id} не установлен мерчант'})
                     Logger.warning(f'На объекте {res.object_id} не установлен мерчант')
@@ -241,8 +242,9 @@ class YookassaPaymentLinks(Resource):
 
         elif entity_type == Entity.OBJECT:
             # оплата аванса по договору
-            if not is_nominal_object(ses, object_id=entity_id):
-                merchant_id = get_franchise_id_by_object_id(ses, entity_id)
+            merchant = merchant_resolver.resolve_object(ses, entity_id)
+            if not merchant.is_nominal:
+                merchant_id = merchant.franchise_id
                 if not merchant_id:
                     abort(400, message={'message': f'На объекте {entity_id} не установлен мерчант'})
                     Logger.warning(f'На объекте {entity_id} не установлен мерчант')
@@ -275,7 +277,7 @@ class YookassaPaymentLending(Resource):
         """
         now = datetime.now()
         data = {}
-        transaction: Transactions = ses.query(Transactions).get(transaction_id)
+        transaction: Transactions = query_profile(ses, Transactions, 'bare').get(transaction_id)
         order = transaction.entity_code
         is_act = transaction.transaction_type_code == TransactionTypeCode.CERTIFICATE_PAYMENT
         if is_act:
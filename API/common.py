@@ -5,17 +5,21 @@ from traceback import format_exc
 from aiohttp import ClientSession
 from flask import make_response, jsonify
 from requests import post
-from sqlalchemy import bindparam as bind, and_
+from sqlalchemy import and_
+from sqlalchemy.orm import aliased
+from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.sql import func
 
 from Config import configs
 from AuthManager import DepartmentEnum
-from DB.models import Franchise, GeneratorOrder, Transactions, CertificateStatus, getData, FranchiseXStatus, \
-    AmoObjects, Budgets, Report, ObjectBudget, ParticipantsXObject
+from DB.models import Franchise, Transactions, CertificateStatus, getData, \
+    AmoObjects, Budgets, Report, ParticipantsXObject, ORDER_ID_PREFIX
+from DB.sequences import order_id_allocator
+from DB.temporal import certificate_status_history, franchise_status_history, participants_history
 from Logger import get_logger
 
-from Services.common import Entity, TransactionTypeCode, PaymentTypes, is_nominal_object, CertificateStatusEnum, \
-    FranchiseType
+from Services.directory import franchise_directory, merchant_resolver
+from Services.common import Entity, TransactionTypeCode, PaymentTypes, CertificateStatusEnum, FranchiseType
 
 
 
@@ -42,15 +46,16 @@ def get_ssd(ses) -> dict:
     :return:
     """
     ssd_franchise_id = configs.get('ssd').get('franchise_id')
-    ssd = ses.query(Franchise.name,
-                    Franchise.inn,
-                    Franchise.kpp,
-                    Franchise.bank_code,
-                    Franchise.account,
-                    bind("type", "payment_contract")). \
-        filter_by(franchise_id=ssd_franchise_id).one()
+    ssd = franchise_directory.get(ssd_franchise_id, ses)
+    if not ssd:
+        raise NoResultFound(f'Франчайзи {ssd_franchise_id} не найден')
 
-    return ssd._asdict()
+    return {'name': ssd.name,
+            'inn': ssd.inn,
+            'kpp': ssd.kpp,
+            'bank_code': ssd.bank_code,
+            'account': ssd.account,
+            'type': 'payment_contract'}
 
 
 sber_commission_percent = int(configs.get('commissions').get('sber'))
@@ -83,11 +88,17 @@ def check_entity(value: str) -> Optional[Entity]:
         raise ValueError()
 
 
-def get_new_order_id(ses):
-    a = GeneratorOrder()
-    ses.add(a)
-    ses.commit()
-    return a.order_id
+def get_new_order_id(ses) -> str:
+    """
+    Номер нового заказа (формат значения по умолчанию generator_id.order). Значение последовательности
+    берётся из зарезервированного процессом блока, без записи и фиксации сессии вызывающего кода.
+    Номера уникальны, но при order_id.block_size > 1 номера разных процессов не упорядочены по времени
+    выдачи: сортировать заказы по номеру как по времени создания нельзя
+
+    :param ses: сессия sql alchemy
+    :return: номер заказа
+    """
+    return f'{ORDER_ID_PREFIX}{order_id_allocator.next(ses)}'
 
 
 def is_last_certificate_transaction(ses, certificate_code: str) -> bool:
@@ -110,6 +121,63 @@ def is_last_certificate_transaction(ses, certificate_code: str) -> bool:
     return closed_amount == billing_amount
 
 
+def certificate_payment_state(ses, certificate_code: str, transaction_id: str):
+    """
+    Состояние оплаты акта одним запросом: суммы выставленных и закрытых платежей, текущий статус акта,
+    тип франчайзи и участник объекта текущей транзакции, номер акта и смета.
+
+    :param ses: Сессия sql alchemy.
+    :param certificate_code: Идентификатор акта.
+    :param transaction_id: Идентификатор транзакции.
+    """
+    is_closed = and_(Transactions.transaction_type_code == TransactionTypeCode.CERTIFICATE_PAYMENT.value,
+                     Transactions.payment_type.not_in(('billing', 'debt')),
+                     Transactions.is_closed.is_(True))
+    current_trs = aliased(Transactions)
+
+    old_status_id = certificate_status_history.current(ses, certificate_code=certificate_code). \
+        with_entities(CertificateStatus.status_id). \
+        limit(1).scalar_subquery()
+    franchise_type = ses.query(Franchise.franchise_type). \
+        select_from(current_trs). \
+        join(AmoObjects, AmoObjects.objects_id == current_trs.object_id). \
+        join(Franchise, Franchise.franchise_id == AmoObjects.franchise_id). \
+        filter(current_trs.transaction_id == transaction_id). \
+        limit(1).scalar_subquery()
+    participant = ses.query(ParticipantsXObject.user_id). \
+        select_from(current_trs). \
+        join(ParticipantsXObject, and_(ParticipantsXObject.object_id == current_trs.object_id,
+                                       ParticipantsXObject.department_id == FRANCHISE_DEPARTMENT_ID,
+                                       participants_history.is_current())). \
+        filter(current_trs.transaction_id == transaction_id). \
+        limit(1).scalar_subquery()
+    certificate_num = ses.query(Report.certificate_num). \
+        filter(Report.certificate_code == certificate_code).limit(1).scalar_subquery()
+    budget_id = ses.query(Report.budgets_id). \
+        filter(Report.certificate_code == certificate_code).limit(1).scalar_subquery()
+
+    billing_sum = func.sum(Transactions.amount).filter(Transactions.payment_type == 'billing')
+    closed_sum = func.sum(Transactions.amount).filter(is_closed)
+    identified_sum = func.sum(Transactions.amount).filter(and_(is_closed, Transactions.is_identify.is_(True)))
+    prepayment_sum = func.sum(Transactions.amount).filter(and_(is_closed, Transactions.payment_type == 'prepayment'))
+    other_closed = func.count().filter(and_(is_closed, Transactions.transaction_id != transaction_id))
+
+    return ses.query(billing_sum.label('billing_amount'),
+                     func.coalesce(closed_sum, 0).label('closed_amount'),
+                     func.coalesce(identified_sum, 0).label('identified_amount'),
+                     func.coalesce(prepayment_sum, 0).label('prepayment_amount'),
+                     func.count().filter(is_closed).label('closed_count'),
+                     other_closed.label('other_closed_count'),
+                     old_status_id.label('old_status_id'),
+                     franchise_type.label('franchise_type'),
+                     participant.label('participant'),
+                     certificate_num.label('certificate_num'),
+                     budget_id.label('budget_id')). \
+        select_from(Transactions). \
+        filter(Transactions.entity_code == certificate_code,
+               Transactions.is_active.is_(True)).one()
+
+
 def set_certificate_status(ses, certificate_code: str, transaction_id: str) -> bool:
     """
     Проставляет статус акта в зависимости от поступившего платежа.
@@ -120,42 +188,16 @@ def set_certificate_status(ses, certificate_code: str, transaction_id: str) -> b
     """
     date_now = getData()
     last_pay = False
-    billing_amount = ses.query(Transactions.amount). \
-        filter(Transactions.entity_code == certificate_code,
-               Transactions.payment_type == 'billing',
-               Transactions.is_active.is_(True)).scalar()
-    closed_transactions = ses.query(Transactions). \
-        filter(Transactions.entity_code == certificate_code,
-               Transactions.transaction_type_code == TransactionTypeCode.CERTIFICATE_PAYMENT.value,
-               Transactions.payment_type.not_in(('billing', 'debt')),
-               Transactions.is_closed.is_(True),
-               Transactions.is_active.is_(True)).all()
-    closed_amount = sum(ct.amount for ct in closed_transactions)
-    identified_amount = sum(ct.amount for ct in closed_transactions if ct.is_identify)
-    prepayment_amount = sum(ct.amount for ct in closed_transactions if ct.payment_type == 'prepayment')
-    is_last_transaction = closed_amount == billing_amount
-    is_first_transaction = closed_transactions and \
-                           len([ct for ct in closed_transactions if ct.transaction_id != transaction_id]) == 0
-    sq_old_status = ses.query(CertificateStatus). \
-        filter_by(certificate_code=certificate_code,
-                  date_end=getData(datetime.max))
-    old_status = sq_old_status.first()
+    state = certificate_payment_state(ses, certificate_code, transaction_id)
+    closed_amount = state.closed_amount
+    is_last_transaction = closed_amount == state.billing_amount
+    is_first_transaction = state.closed_count and state.other_closed_count == 0
     new_status_id = None
     if not closed_amount:
         new_status_id = CertificateStatusEnum.READY_TO_PAY.value
-    elif is_last_transaction and (closed_amount - prepayment_amount) == identified_amount:
+    elif is_last_transaction and (closed_amount - state.prepayment_amount) == state.identified_amount:
         #TODO убрать амо обжекст добавить budgets и fanchise_id брать из subsidiary в budgets
-        franchise_type,participant = ses.query(Franchise.franchise_type,ParticipantsXObject.user_id). \
-            select_from(Transactions). \
-            join(ParticipantsXObject,and_(
-                ParticipantsXObject.object_id == Transactions.object_id,
-                ParticipantsXObject.department_id == FRANCHISE_DEPARTMENT_ID,
-                ParticipantsXObject.date_end == MAX_DATE),isouter=True).\
-            join(AmoObjects, AmoObjects.objects_id == Transactions.object_id). \
-            join(Franchise, Franchise.franchise_id == AmoObjects.franchise_id). \
-            filter(Transactions.transaction_id == transaction_id).one()
-
-        if franchise_type == FranchiseType.PERFORMER and not participant:
+        if state.franchise_type == FranchiseType.PERFORMER and not state.participant:
             new_status_id = CertificateStatusEnum.COMPLETED_PAID.value
         else:
             new_status_id = CertificateStatusEnum.IDENTIFIED_PAID
@@ -164,43 +206,36 @@ def set_certificate_status(ses, certificate_code: str, transaction_id: str) -> b
         new_status_id = CertificateStatusEnum.UNIDENTIFIED_PAID.value
     elif is_first_transaction or closed_amount:
         new_status_id = CertificateStatusEnum.PARTIALLY_PAID.value
-    if new_status_id and (not old_status or old_status.status_id != new_status_id):
-        sq_old_status.update({'date_end': date_now})
-        ses.add(CertificateStatus(certificate_code=certificate_code,
-                                  status_id=new_status_id,
-                                  date_start=date_now,
-                                  user_id=0))
+    if new_status_id and state.old_status_id != new_status_id:
+        certificate_status_history.transition(ses,
+                                              {'certificate_code': certificate_code,
+                                               'status_id': new_status_id,
+                                               'user_id': 0},
+                                              at=date_now)
     if new_status_id in (CertificateStatusEnum.COMPLETED_PAID,
                          CertificateStatusEnum.IDENTIFIED_PAID,
                          CertificateStatusEnum.UNIDENTIFIED_PAID):
-        cert_num, budget_id = ses.query(Report.certificate_num, Report.budgets_id). \
-            filter(Report.certificate_code == certificate_code).one()
-        ses.query(Budgets).filter(Budgets.budgets_id == budget_id).update({'last_paid_cert': cert_num})
+        ses.query(Budgets). \
+            filter(Budgets.budgets_id == state.budget_id). \
+            update({'last_paid_cert': state.certificate_num})
     return last_pay
 
 
 def set_franchisee_status(ses, params):
-    date_now = datetime.now()
-    max_date = getData(datetime.max)
-    ses.query(FranchiseXStatus). \
-        filter_by(franchise_id=params.get('franchise_id'), date_end=max_date).update({'date_end': date_now})
-    ses.add(FranchiseXStatus(**params))
+    franchise_status_history.transition(ses, params, at=getData())
 
 
 def get_franchise_id_by_object_id(ses, object_id: int) -> int:
-    return ses.query(AmoObjects.franchise_id).filter_by(objects_id=object_id).scalar()
+    return merchant_resolver.resolve_object(ses, object_id).franchise_id
 
 
-def get_franchise_id_by_cert_code(ses, certificate_code: str) -> int:
-    return ses.query(AmoObjects.franchise_id). \
-        join(ObjectBudget, ObjectBudget.object_id == AmoObjects.objects_id). \
-        join(Report, and_(Report.budgets_id == ObjectBudget.budgets_id,
-                          Report.certificate_code == certificate_code)). \
-        scalar()
+def get_franchise_id_by_cert_code(ses, certificate_code: str) -> Optional[int]:
+    merchant = merchant_resolver.resolve_certificate(ses, certificate_code)
+    return merchant.franchise_id if merchant else None
 
 
 def is_with_agent(ses, object_id: int, certificate_code: str) -> bool:
-    is_nominal = is_nominal_object(ses, object_id)
+    is_nominal = merchant_resolver.resolve_object(ses, object_id).is_nominal
 
     transactions = ses.query(Transactions).filter_by(object_id=object_id,
                                                      payment_type=PaymentTypes.CASH,
@@ -224,7 +259,8 @@ class MessageService:
         try:
             post(self.URL,
                  cookies={'access_token_cookie': self.TOKEN},
-                 json=payload)
+                 json=payload,
+                 timeout=(configs.get('notifications') or {}).get('timeout', 10))
         except Exception as err:
             self.__log_error(err)
 
@@ -238,6 +274,5 @@ class MessageService:
             self.__log_error(err)
 
     def __log_error(self, err):
-        self.logger.error('Не удалось отправить сообщение через внутренний сервис уведомлений',
-                          str(err),
-                          format_exc())
+        self.logger.error(f'Не удалось отправить сообщение через внутренний сервис уведомлений: '
+                          f'{str(err)}\n{format_exc()}')
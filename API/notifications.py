@@ -0,0 +1,145 @@
+import asyncio
+import atexit
+import os
+from queue import SimpleQueue, Empty
+from threading import Thread, Lock
+from typing import Iterable, List, Optional
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+
+from API.common import MessageService
+from Config import configs
+from Logger import get_logger
+
+Logger = get_logger('notification_dispatcher', 'ecosystem_cors')
+
+_STOP = object()
+
+
+def _config() -> dict:
+    return configs.get('notifications') or {}
+
+
+async def dispatch(payloads: Iterable[dict], session: ClientSession = None) -> List[Optional[int]]:
+    """
+    Отправка пакета уведомлений с ограничением числа одновременных запросов и повтором неудачных
+
+    :param payloads: уведомления
+    :param session: общая сессия aiohttp (если не указана, создаётся на время пакета)
+    :return: HTTP статусы ответов в порядке уведомлений (None, если уведомление не отправлено)
+    """
+    cfg = _config()
+    if session is None:
+        async with _client_session() as session:
+            return await dispatch(payloads, session)
+
+    service = MessageService()
+    semaphore = asyncio.Semaphore(cfg.get('concurrency', 10))
+    retries, backoff = cfg.get('retries', 3), cfg.get('backoff', 0.5)
+
+    async def send(payload: dict) -> Optional[int]:
+        status = None
+        for attempt in range(retries + 1):
+            if attempt:
+                await asyncio.sleep(backoff * 2 ** (attempt - 1))
+            async with semaphore:
+                status = await service.send_async_notification(payload, session)
+            if status is not None and status < 500:
+                break
+        return status
+
+    return await asyncio.gather(*(send(payload) for payload in payloads))
+
+
+def _client_session() -> ClientSession:
+    cfg = _config()
+    return ClientSession(timeout=ClientTimeout(total=cfg.get('timeout', 10)),
+                         connector=TCPConnector(limit=cfg.get('concurrency', 10)))
+
+
+class NotificationDispatcher:
+    """
+    Буфер уведомлений сервиса уведомлений Domeo ERP. Постановка в очередь не ждёт сети, фоновый поток
+    отправляет накопленные уведомления пакетами через одну сессию aiohttp
+    """
+
+    def __init__(self, batch_size: int = 50, flush_interval: float = 1):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = SimpleQueue()
+        self._thread = None
+        self._pid = None
+        self._lock = Lock()
+
+    def enqueue(self, payload: dict):
+        """
+        Постановка уведомления в очередь отправки
+
+        :param payload: уведомление
+        """
+        self._ensure_started()
+        self._queue.put(payload)
+
+    def close(self, timeout: float = 10):
+        """
+        Отправка накопленных уведомлений и остановка фонового потока
+
+        :param timeout: время ожидания отправки (с)
+        """
+        if self._thread and self._pid == os.getpid() and self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+
+    def _ensure_started(self):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid != os.getpid() or not self._thread.is_alive():
+                # поток не переживает fork (prefork Celery, воркеры gunicorn) - запускаем заново
+                if self._pid != os.getpid():
+                    self._queue = SimpleQueue()
+                self._thread = Thread(target=self._run, name='notification-dispatcher', daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def _next_batch(self) -> tuple:
+        # первое уведомление ждём без ограничения, остальные - не дольше flush_interval
+        batch, stop = [], False
+        item = self._queue.get()
+        while True:
+            if item is _STOP:
+                stop = True
+                break
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                break
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except Empty:
+                break
+        return batch, stop
+
+    def _run(self):
+        asyncio.run(self._loop())
+
+    async def _loop(self):
+        loop = asyncio.get_running_loop()
+        async with _client_session() as session:
+            while True:
+                batch, stop = await loop.run_in_executor(None, self._next_batch)
+                if batch:
+                    try:
+                        statuses = await dispatch(batch, session)
+                    except Exception as e:
+                        statuses = [None] * len(batch)
+                        Logger.error(f'Ошибка отправки пакета уведомлений: {e.__class__.__name__} ({str(e)})')
+                    failed = sum(status is None or status >= 400 for status in statuses)
+                    if failed:
+                        Logger.error(f'Не отправлено уведомлений: {failed} из {len(batch)}')
+                if stop:
+                    break
+
+
+notification_dispatcher = NotificationDispatcher(batch_size=_config().get('batch_size', 50),
+                                                 flush_interval=_config().get('flush_interval', 1))
+atexit.register(notification_dispatcher.close)
@@ -1,10 +1,18 @@
 import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 from functools import reduce
+from threading import Lock
+from time import monotonic
+from typing import Optional
+from urllib.parse import urlsplit
 
 import requests
 
+from Config import configs
+from Logger import get_logger
 from Services.common import PaymentMethod, PaymentObject, TransactionTypeCode
 
 
@@ -98,12 +106,110 @@ def check_date(return_datetime: bool = False):
     return checker
 
 
+class UrlReachabilityChecker:
+    """
+    Фоновая проверка доступности сайтов (схема и хост URL) с кэшированием результата на время TTL.
+    Запрос не ждёт проверки: результат только логируется и доступен через is_reachable.
+    Кэш ограничен max_size сайтами, при переполнении вытесняются давно не проверявшиеся
+    """
+
+    def __init__(self, ttl: float = 3600, timeout: float = 5, max_workers: int = 2, max_size: int = 1024):
+        self.ttl = ttl
+        self.timeout = timeout
+        self.max_size = max_size
+        self.logger = get_logger('url_checker', 'url_checker')
+        self._results = OrderedDict()
+        self._pending = set()
+        self._lock = Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='url_checker')
+
+    @staticmethod
+    def site(url: str) -> str:
+        """
+        Адрес сайта URL (ключ кэша): адреса возврата уникальны для заказа, доступность проверяется по сайту
+
+        :param url: адрес
+        :return: схема и хост адреса
+        """
+        parts = urlsplit(url)
+        return f'{parts.scheme}://{parts.netloc.lower()}/'
+
+    def _fresh(self, site: str) -> Optional[tuple]:
+        # вызывается под блокировкой
+        checked = self._results.get(site)
+        if checked is None:
+            return None
+        if monotonic() - checked[0] >= self.ttl:
+            del self._results[site]
+            return None
+        return checked
+
+    def submit(self, url: str):
+        """
+        Постановка сайта URL на проверку, если для него нет свежего результата
+
+        :param url: проверяемый адрес
+        """
+        site = self.site(url)
+        with self._lock:
+            if site in self._pending or self._fresh(site):
+                return
+            self._pending.add(site)
+        self._executor.submit(self._check, site)
+
+    def is_reachable(self, url: str) -> Optional[bool]:
+        """
+        Последний результат проверки сайта URL
+
+        :param url: проверяемый адрес
+        :return: доступен ли сайт или None, если проверка ещё не выполнялась или результат устарел
+        """
+        with self._lock:
+            checked = self._fresh(self.site(url))
+        return checked[1] if checked else None
+
+    def _check(self, site: str):
+        try:
+            r = requests.head(site, headers={'User-Agent': user_agent_val}, timeout=self.timeout)
+            reachable = r.status_code <= 399
+            if not reachable:
+                self.logger.warning(f'Сайт {site} недоступен: код ответа {r.status_code}')
+        except Exception as e:
+            reachable = False
+            self.logger.warning(f'Сайт {site} недоступен: {e.__class__.__name__} ({str(e)})')
+        with self._lock:
+            self._results[site] = (monotonic(), reachable)
+            self._results.move_to_end(site)
+            while len(self._results) > self.max_size:
+                self._results.popitem(last=False)
+            self._pending.discard(site)
+
+
+url_cfg = configs.get('return_url') or {}
+url_checker = UrlReachabilityChecker(ttl=url_cfg.get('check_ttl', 3600), max_size=url_cfg.get('check_cache_size', 1024))
+
+
+def is_allowed_domain(host: str, allowed_domains) -> bool:
+    host = host.lower().rstrip('.')
+    return any(host == domain or host.endswith(f'.{domain}') for domain in map(str.lower, allowed_domains))
+
+
 def check_url(value: str):
-    try:
-        r = requests.head(value, headers={'User-Agent': user_agent_val})
-        if r.status_code > 399:
-            raise ConnectionError(f'В ответе код ошибки {r.status_code}: {r.text}')
-    except Exception as e:
-        raise ValueError(f'URL не прошёл проверку: {str(e)}')
+    """
+    Валидация URL: синтаксис и белый список доменов (return_url.allowed_domains).
+    Доступность адреса проверяется в фоне и не влияет на время ответа
+
+    :param value: строка URL
+    :return: URL
+    :raise: ValueError
+    """
+    parts = urlsplit(value)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ValueError('URL не прошёл проверку: некорректный адрес')
+    allowed_domains = url_cfg.get('allowed_domains')
+    if allowed_domains and not is_allowed_domain(parts.hostname, allowed_domains):
+        raise ValueError(f'URL не прошёл проверку: домен {parts.hostname} не разрешён')
+
+    url_checker.submit(value)
 
     return value
@@ -3,6 +3,7 @@ from flask_restful import reqparse
 from API.common import check_entity
 from API.parsing_common import check_url, check_payment_method
 from DB import DbName, withSession
+from DB.loading import query_profile
 from DB.models import Transactions
 
 __all__ = ('PaymentsBody', 'PaymentsBase', 'PaymentsLink')
@@ -10,7 +11,7 @@ __all__ = ('PaymentsBody', 'PaymentsBase', 'PaymentsLink')
 
 @withSession(DbName.CORE)
 def check_transaction(ses, value) -> Transactions:
-    transaction = ses.query(Transactions).get(value)
+    transaction = query_profile(ses, Transactions, 'bare').get(value)
 
     if not transaction:
         raise ValueError("Транзакция не найдена")
@@ -64,6 +65,11 @@ PaymentsBody.add_argument('merchant_id',
                           help='идентификатор мерчанта',
                           required=False,
                           location='json')
+PaymentsBody.add_argument('email',
+                          type=str,
+                          help='адрес для отправки ссылки на оплату',
+                          required=False,
+                          location='json')
 
 PaymentsLink = reqparse.RequestParser()
 PaymentsLink.add_argument('transaction_id',
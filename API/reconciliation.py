@@ -0,0 +1,158 @@
+from collections import namedtuple
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+from Config import configs
+from DB.models import Transactions, TransactionReport
+from Logger import get_logger
+
+ReconciliationResult = namedtuple('ReconciliationResult', ('matched', 'missing', 'duplicates', 'amount_mismatch'))
+
+Logger = get_logger('acquiring_reconciliation', 'acquiring_reconciliation')
+
+
+class AcquiringReconciliation:
+    """
+    Сверка отчёта эквайринга с транзакциями. Отчёт и транзакции окна дат загружаются в таблицы pandas
+    и сопоставляются по номеру заказа эквайринга и сумме за несколько проходов над множествами
+    """
+
+    def __init__(self, ses, tolerance: float = None, window_days: int = None):
+        """
+        :param ses: сессия sql alchemy
+        :param tolerance: допустимое расхождение суммы
+        :param window_days: запас окна дат транзакций относительно дат операций отчёта (дни)
+        """
+        cfg = configs.get('reconciliation') or {}
+        self.ses = ses
+        self.tolerance = cfg.get('tolerance', 0.01) if tolerance is None else tolerance
+        self.window_days = cfg.get('window_days', 3) if window_days is None else window_days
+
+    def load_report(self, report_id: str) -> pd.DataFrame:
+        """
+        Операции отчёта эквайринга
+
+        :param report_id: идентификатор отчёта
+        :return: таблица с колонками order_id, transaction_date, amount, fee
+        """
+        query = self.ses.query(TransactionReport.transaction_id.label('order_id'),
+                               TransactionReport.transaction_date,
+                               TransactionReport.amount,
+                               TransactionReport.fee). \
+            filter(TransactionReport.report_id == report_id)
+        return pd.read_sql(query.statement, self.ses.connection())
+
+    def load_transactions(self, report: pd.DataFrame) -> pd.DataFrame:
+        """
+        Активные транзакции эквайринга в окне дат операций отчёта
+
+        :param report: операции отчёта
+        :return: таблица с колонками transaction_id, order_id, amount, fee, is_identify
+        """
+        columns = ('transaction_id', 'order_id', 'amount', 'fee', 'is_identify')
+        dates = report['transaction_date'].dropna()
+        if dates.empty:
+            return pd.DataFrame(columns=columns)
+
+        window = timedelta(days=self.window_days)
+        query = self.ses.query(Transactions.transaction_id,
+                               Transactions.acquiring_order_id.label('order_id'),
+                               Transactions.amount,
+                               Transactions.fee,
+                               Transactions.is_identify). \
+            filter(Transactions.acquiring_order_id.isnot(None),
+                   Transactions.is_active.is_(True),
+                   Transactions.transaction_date.between(dates.min() - window, dates.max() + window))
+        return pd.read_sql(query.statement, self.ses.connection())
+
+    def reconcile(self, report: pd.DataFrame, transactions: pd.DataFrame) -> ReconciliationResult:
+        """
+        Сопоставление операций отчёта и транзакций
+
+        :param report: операции отчёта
+        :param transactions: транзакции
+        :return: сопоставленные операции, операции без транзакций, повторы номера заказа (в отчёте или
+            транзакциях) и расхождения суммы
+        """
+        report_dup = report['order_id'].duplicated(keep=False)
+        trs_dup = transactions['order_id'].duplicated(keep=False)
+        duplicates = pd.concat((report[report_dup].assign(source='report'),
+                                transactions[trs_dup].assign(source='transactions')),
+                               ignore_index=True)
+        dup_orders = set(duplicates['order_id'])
+
+        merged = report[~report['order_id'].isin(dup_orders)]. \
+            merge(transactions[~transactions['order_id'].isin(dup_orders)],
+                  on='order_id', how='left', suffixes=('_report', '_trs'), indicator=True)
+        found = merged['_merge'] == 'both'
+        missing = merged.loc[~found, ['order_id', 'transaction_date', 'amount_report', 'fee_report']]
+
+        both = merged[found]
+        equal = np.isclose(both['amount_report'].to_numpy(dtype=float),
+                           both['amount_trs'].to_numpy(dtype=float),
+                           rtol=0, atol=self.tolerance)
+        return ReconciliationResult(matched=both[equal].drop(columns='_merge'),
+                                    missing=missing,
+                                    duplicates=duplicates,
+                                    amount_mismatch=both[~equal].drop(columns='_merge'))
+
+    def apply(self, result: ReconciliationResult) -> int:
+        """
+        Отметка сопоставленных транзакций идентифицированными и запись комиссии из отчёта.
+        Обновляются только изменившиеся транзакции, одним пакетом
+
+        :param result: результат сопоставления
+        :return: количество обновлённых транзакций
+        """
+        matched = result.matched
+        fee_report = matched['fee_report'].to_numpy(dtype=float)
+        fee_trs = matched['fee_trs'].to_numpy(dtype=float)
+        same_fee = np.isclose(fee_report, fee_trs, rtol=0, atol=self.tolerance) | \
+            (np.isnan(fee_report) & np.isnan(fee_trs))
+        changed = matched[~(matched['is_identify'].fillna(False).astype(bool).to_numpy() & same_fee)]
+
+        mappings = [{'transaction_id': transaction_id,
+                     'is_identify': True,
+                     'fee': None if pd.isna(fee) else float(fee)}
+                    for transaction_id, fee in zip(changed['transaction_id'], changed['fee_report'])]
+        if mappings:
+            self.ses.bulk_update_mappings(Transactions, mappings)
+        return len(mappings)
+
+    def run(self, report_id: str, dry_run: bool = False) -> ReconciliationResult:
+        """
+        Сверка отчёта: загрузка, сопоставление и (если не dry_run) обновление транзакций без фиксации сессии
+
+        :param report_id: идентификатор отчёта
+        :param dry_run: только сопоставление, без обновления транзакций
+        :return: результат сопоставления
+        """
+        report = self.load_report(report_id)
+        result = self.reconcile(report, self.load_transactions(report))
+        updated = 0 if dry_run else self.apply(result)
+        Logger.info(f'Отчёт {report_id}: операций {len(report)}, сопоставлено {len(result.matched)} '
+                    f'(обновлено {updated}), без транзакции {len(result.missing)}, '
+                    f'повторы {len(result.duplicates)}, расхождение суммы {len(result.amount_mismatch)}')
+        return result
+
+
+def notification(report_id: str, result: ReconciliationResult, sample_size: int = 10) -> dict:
+    """
+    Уведомление об итогах сверки отчёта для сервиса уведомлений Domeo ERP: количество сопоставленных
+    операций и номера заказов операций, требующих разбора
+
+    :param report_id: идентификатор отчёта
+    :param result: результат сопоставления
+    :param sample_size: количество номеров заказов каждого вида расхождений в уведомлении
+    :return: уведомление
+    """
+    lines = [f'Сверка отчёта эквайринга {report_id}: сопоставлено операций {len(result.matched)}']
+    for title, frame in (('без транзакции', result.missing),
+                         ('повторы номера заказа', result.duplicates),
+                         ('расхождение суммы', result.amount_mismatch)):
+        if len(frame):
+            orders = ', '.join(str(order_id) for order_id in frame['order_id'].drop_duplicates().head(sample_size))
+            lines.append(f'{title}: {len(frame)} ({orders})')
+    return {'group_id': (configs.get('reconciliation') or {}).get('notify_group_id'), 'message': '\n'.join(lines)}
@@ -1,37 +1,245 @@
+import asyncio
+from datetime import datetime, timedelta
+from typing import Optional
+
+from celery import chord
+from sqlalchemy.dialects.postgresql import insert
+
+from MainApp.cache import file_cache
 from MainApp.celery import app
 from Services.SberAcquiring import FactoryReport
-from TelegramBot.webHooks import reportError, crossReportSber
+from TelegramBot.webHooks import reportError
 
+from API.common import MessageService
+from API.notifications import dispatch
+from Config import configs
+from DB import Session, DbName
+from DB.migrations import requireMigrations
+from DB.models import AcquiringReportWatermark, ReportAcquiring, getData
 from Logger import get_logger
 from Services import LifePayService, ServiceError
 
-from Services.common import ReportGroup
+from Services.Smtp import Service as SmtpService
+from Services.orders_import import OrdersImport
+from Services.common import ReportGroup, Merchant
 
 
 Logger = get_logger('tochka-api-tasks', 'tochka-api-tasks')
 
 
+# ----------------------------------------------------------------------------------------------------------------------
+#                                               Отметки обработанных отчётов
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def get_report_watermark(report_group: str) -> Optional[datetime]:
+    """
+    Дата получения последнего обработанного отчёта группы
+
+    :param report_group: группа отчётов (ReportGroup)
+    :return: дата получения или None, если отчёты группы ещё не обрабатывались
+    """
+    requireMigrations(DbName.CORE, '0007_acquiring_report_watermarks')
+    with Session(DbName.CORE) as ses:
+        return ses.query(AcquiringReportWatermark.received).filter_by(report_group=report_group).scalar()
+
+
+def advance_report_watermark(report_group: str, report_ids: list):
+    """
+    Перенос отметки группы на последний по дате получения из обработанных отчётов (только вперёд)
+
+    :param report_group: группа отчётов (ReportGroup)
+    :param report_ids: идентификаторы обработанных отчётов
+    """
+    with Session(DbName.CORE) as ses:
+        latest = ses.query(ReportAcquiring.report_id, ReportAcquiring.received). \
+            filter(ReportAcquiring.report_id.in_(report_ids), ReportAcquiring.received.isnot(None)). \
+            order_by(ReportAcquiring.received.desc()). \
+            first()
+        if latest is None:
+            return
+        stmt = insert(AcquiringReportWatermark).values(report_group=report_group,
+                                                       received=latest.received,
+                                                       report_id=latest.report_id,
+                                                       updated_date=getData())
+        ses.execute(stmt.on_conflict_do_update(
+            index_elements=[AcquiringReportWatermark.report_group],
+            set_={'received': stmt.excluded.received,
+                  'report_id': stmt.excluded.report_id,
+                  'updated_date': stmt.excluded.updated_date},
+            where=AcquiringReportWatermark.received.is_(None) | (AcquiringReportWatermark.received < latest.received)))
+        ses.commit()
+
+
+def new_reports(report_ids: list, since: Optional[datetime]) -> list:
+    """
+    Отчёты, полученные после отметки группы, в порядке получения
+
+    :param report_ids: идентификаторы отчётов
+    :param since: дата получения последнего обработанного отчёта группы
+    :return: идентификаторы необработанных отчётов (отчёты без даты получения - в конце)
+    """
+    if not report_ids:
+        return []
+    with Session(DbName.CORE) as ses:
+        received = dict(ses.query(ReportAcquiring.report_id, ReportAcquiring.received).
+                        filter(ReportAcquiring.report_id.in_(report_ids)))
+    reports = [report_id for report_id in dict.fromkeys(report_ids)
+               if since is None or received.get(report_id) is None or received[report_id] > since]
+    return sorted(reports, key=lambda report_id: (received.get(report_id) is None,
+                                                  received.get(report_id) or datetime.min))
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 #                                               Асинхронные задачи
 # ----------------------------------------------------------------------------------------------------------------------
 
 
-@app.task(autoretry_for=(ServiceError,), max_retries=2)
+@app.task
 def get_acquiring_reports_task():
     """
-    Периодический опрос почты на наличие отчётов эквайринга
+    Периодический опрос почты на наличие отчётов эквайринга: группы отчётов опрашиваются параллельно,
+    итог собирается задачей acquiring_reports_done
+    """
+    chord(fetch_report_group_task.s(creditor.value) for creditor in ReportGroup)(acquiring_reports_done.s())
+
+
+@app.task
+def fetch_report_group_task(report_group: str) -> dict:
+    """
+    Получение отчётов группы, полученных после отметки группы. Отчёты сверяются параллельно,
+    отметка группы переносится задачей-итогом только после успешной сверки всех отчётов, поэтому
+    следующий опрос повторит отчёты, если сверка какого-либо из них не удалась
+
+    :param report_group: группа отчётов (ReportGroup)
+    :return: группа, количество полученных отчётов и ошибка, если опрос прерван
     """
     try:
-        reports = []
-        for creditor in ReportGroup:
-            au = FactoryReport.create_report_service(creditor.value)
-            report = au.get_acquiring_reports()
-            reports.extend(report)
-        if reports:
-            for report_id in reports:
-                crossReportSber(report_id=report_id)
+        since = get_report_watermark(report_group)
+        au = FactoryReport.create_report_service(report_group)
+        # с почты загружаются только отчёты после отметки группы
+        report_ids = new_reports(list(au.get_acquiring_reports(since=since)), since)
+        if report_ids:
+            chord(cross_report_task.si(report_id) for report_id in report_ids)(
+                advance_report_watermark_task.si(report_group, report_ids))
     except Exception as e:
-        reportError()
-        Logger.error(f'Не удалось получить отчёты с почты: {e.__class__.__name__} ({str(e)})')
+        # ошибка одной группы не прерывает остальные, следующий запуск продолжит с отметки группы
+        Logger.error(f'Не удалось получить отчёты {report_group} с почты: {e.__class__.__name__} ({str(e)})')
+        return {'group': report_group, 'fetched': 0, 'error': f'{e.__class__.__name__} ({str(e)})'}
+
+    return {'group': report_group, 'fetched': len(report_ids), 'error': None}
+
+
+@app.task(bind=True, autoretry_for=(ServiceError,), max_retries=2)
+def cross_report_task(self, report_id: str):
+    """
+    Сверка отчёта эквайринга с транзакциями: пакетное сопоставление и отметка транзакций, затем уведомление.
+    Ошибка, после которой сверка не будет повторена, отправляется через reportError
+
+    :param report_id: идентификатор отчёта
+    """
+    # pandas загружается при первой сверке, а не при запуске воркера
+    from API.reconciliation import AcquiringReconciliation, notification
+
+    try:
+        with Session(DbName.CORE) as ses:
+            result = AcquiringReconciliation(ses).run(report_id)
+            ses.commit()
+        MessageService().send_notification(notification(report_id, result))
+    except Exception as e:
+        Logger.error(f'Не удалось сверить отчёт {report_id}: {e.__class__.__name__} ({str(e)})')
+        if not isinstance(e, ServiceError) or self.request.retries >= self.max_retries:
+            reportError()
         raise
 
+
+@app.task
+def advance_report_watermark_task(report_group: str, report_ids: list):
+    """
+    Перенос отметки группы отчётов после сверки всех полученных отчётов
+
+    :param report_group: группа отчётов (ReportGroup)
+    :param report_ids: идентификаторы сверенных отчётов
+    """
+    advance_report_watermark(report_group, report_ids)
+
+
+@app.task
+def acquiring_reports_done(results: list):
+    """
+    Итог опроса групп отчётов эквайринга
+
+    :param results: результаты fetch_report_group_task
+    """
+    failed = [result for result in results if result.get('error')]
+    fetched = ', '.join(f"{result['group']}: {result['fetched']}" for result in results)
+    Logger.info(f'Получено отчётов эквайринга: {fetched}')
+    if failed:
+        reportError()
+
+
+@app.task
+def sync_life_pay_receipts_task(days: int = None) -> dict:
+    """
+    Периодическая загрузка чеков LifePay за последние дни в промежуточную таблицу log.life_pay_receipts
+    по каждому мерчанту (постраничный обход списка транзакций)
+
+    :param days: количество дней, включая текущий (по умолчанию life_pay_sync.days)
+    :return: количество загруженных чеков по мерчанту (None, если загрузка не удалась)
+    """
+    days = days or (configs.get('life_pay_sync') or {}).get('days', 2)
+    date_to = datetime.utcnow().date()
+    date_from = date_to - timedelta(days=days - 1)
+    loaded = {}
+    for merchant_name in configs.get('life_pay_mto'):
+        try:
+            loaded[merchant_name] = LifePayService(Merchant.find_merchant(merchant_name)). \
+                stage_transactions(date_from, date_to)
+        except Exception as e:
+            # ошибка одного мерчанта не прерывает загрузку остальных
+            Logger.error(f'Не удалось загрузить чеки LifePay {merchant_name}: {e.__class__.__name__} ({str(e)})')
+            loaded[merchant_name] = None
+    return loaded
+
+
+@app.task(autoretry_for=(ServiceError,), max_retries=3, retry_backoff=True)
+def send_payment_email_task(data: dict, to: str):
+    """
+    Отправка письма со ссылкой на оплату
+
+    :param data: данные шаблона письма
+    :param to: адрес получателя
+    """
+    SmtpService().send_payment(data, to)
+
+
+@app.task
+def send_notifications_task(payloads: list):
+    """
+    Пакетная отправка уведомлений в сервис уведомлений Domeo ERP
+
+    :param payloads: уведомления
+    """
+    statuses = asyncio.run(dispatch(payloads))
+    failed = sum(status is None or status >= 400 for status in statuses)
+    if failed:
+        Logger.error(f'Не отправлено уведомлений: {failed} из {len(payloads)}')
+
+
+@app.task
+def evict_cache_task() -> dict:
+    """
+    Периодическая очистка кэша файлов: истёкшие по TTL и давно не используемые сверх ограничения размера
+    """
+    return file_cache.evict()
+
+
+@app.task
+def import_orders_task(raw_batch_id: int) -> dict:
+    """
+    Загрузка заказов 1С из сырого блока shop_prorabam.orders_raw
+
+    :param raw_batch_id: идентификатор блока сырых данных
+    :return: статистика загрузки
+    """
+    return OrdersImport().run_raw_batch(raw_batch_id)
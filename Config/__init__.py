@@ -1,12 +1,17 @@
-from yaml import load, Loader
 import os
 
+from yaml import load
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 
 config_file = 'config.yaml'
 
 cp = os.path.dirname(os.path.abspath(__file__))
 try:
     with open(os.path.join(cp, config_file), 'r', encoding='utf-8') as f:
-        configs = load(f, Loader)
+        configs = load(f, SafeLoader)
 except FileNotFoundError:
     raise FileNotFoundError(f'Конфигурационный файл {os.path.join(cp, config_file)} не найден системой')
@@ -1,4 +1,6 @@
-from .connections import withSession, DbName, Session
+from .connections import withSession, DbName, Session, getEngine, disposeEngines, poolStats, \
+    scopedSession, removeScopedSessions, registerSessionTeardown
 
 
-__all__ = (withSession, DbName, Session)
+__all__ = (withSession, DbName, Session, getEngine, disposeEngines, poolStats, scopedSession, removeScopedSessions,
+           registerSessionTeardown)
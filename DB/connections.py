@@ -1,15 +1,44 @@
+import os
 from functools import wraps
-from sqlalchemy import create_engine
+from threading import Lock
+from sqlalchemy import create_engine, event
 from contextlib import contextmanager
 from urllib.parse import quote
 
-from sqlalchemy.orm import sessionmaker
+from celery import current_task
+from flask import has_app_context, _app_ctx_stack, g
+from sqlalchemy.orm import sessionmaker, scoped_session
 
 from Config import configs
 
 from DB.enums import DbName
 
 
+# реестр движков и фабрик сессий процесса (по одному пулу соединений на БД)
+_engines = {}
+_session_makers = {}
+_checkout_stats = {}
+_scoped_sessions = {}
+_engines_pid = None
+_engines_lock = Lock()
+
+
+def _poolOptions() -> dict:
+    """
+    Параметры пула соединений из секции postgres.pool конфигурационного файла
+
+    :return: именованные параметры для create_engine
+    """
+    pool_cfg = configs.get('postgres').get('pool') or {}
+    return {
+        'pool_size': pool_cfg.get('size', 5),
+        'max_overflow': pool_cfg.get('max_overflow', 10),
+        'pool_timeout': pool_cfg.get('timeout', 30),
+        'pool_recycle': pool_cfg.get('recycle', 1800),
+        'pool_pre_ping': pool_cfg.get('pre_ping', True),
+    }
+
+
 def makeEngine(db_name: DbName):
     pw = quote(configs.get('postgres').get('password'))
     usr = configs.get('postgres').get('username')
@@ -17,16 +46,200 @@ def makeEngine(db_name: DbName):
     port = configs.get('postgres').get('port')
     hostname = f'{host}:{port}' if port else host
     engineString = f'postgresql://{usr}:{pw}@{hostname}/{db_name.value}'
-    engine = create_engine(engineString)
+    engine = create_engine(engineString, **_poolOptions())
     return engine
 
 
+def _trackCheckouts(db_name: DbName, engine):
+    stats = _checkout_stats[db_name] = {'checkouts': 0, 'max_checked_out': 0}
+
+    @event.listens_for(engine, 'checkout')
+    def on_checkout(*_args):
+        stats['checkouts'] += 1
+        stats['max_checked_out'] = max(stats['max_checked_out'], engine.pool.checkedout())
+
+
+def _resetAfterFork():
+    """
+    Сброс реестра в дочернем процессе (prefork Celery, воркеры gunicorn).
+    Соединения родителя не закрываются, а только забываются, чтобы не сломать его сокеты.
+    """
+    global _engines_pid
+
+    for engine in _engines.values():
+        engine.dispose(close=False)
+    _engines.clear()
+    _session_makers.clear()
+    _checkout_stats.clear()
+    _scoped_sessions.clear()
+    _engines_pid = os.getpid()
+
+
+def _sessionMaker(db_name: DbName) -> sessionmaker:
+    """
+    Фабрика сессий БД из реестра процесса. Создаётся вместе с движком при первом обращении; движок берётся
+    из самой фабрики, поэтому одновременный disposeEngines не оставляет фабрику без движка
+
+    :param db_name: имя БД
+    :return: фабрика сессий sql alchemy
+    """
+    if _engines_pid != os.getpid():
+        with _engines_lock:
+            if _engines_pid != os.getpid():
+                _resetAfterFork()
+
+    maker = _session_makers.get(db_name)
+    if maker is None:
+        with _engines_lock:
+            maker = _session_makers.get(db_name)
+            if maker is None:
+                engine = makeEngine(db_name)
+                _trackCheckouts(db_name, engine)
+                _engines[db_name] = engine
+                maker = _session_makers[db_name] = sessionmaker(bind=engine)
+    return maker
+
+
+def getEngine(db_name: DbName):
+    """
+    Движок БД из реестра процесса. Создаётся при первом обращении и переиспользуется всеми сессиями
+
+    :param db_name: имя БД
+    :return: движок sql alchemy
+    """
+    return _sessionMaker(db_name).kw['bind']
+
+
+def disposeEngines(close: bool = True):
+    """
+    Закрытие всех пулов соединений процесса
+
+    :param close: закрывать ли соединения (False - только забыть их, например в дочернем процессе после fork)
+    """
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose(close=close)
+        _engines.clear()
+        _session_makers.clear()
+        _checkout_stats.clear()
+
+
+def poolStats() -> dict:
+    """
+    Статистика использования пулов соединений процесса
+
+    :return: словарь со статистикой по каждой БД
+    """
+    stats = {}
+    for db_name, engine in list(_engines.items()):
+        pool = engine.pool
+        stats[db_name.value] = {
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow(),
+            **_checkout_stats.get(db_name, {}),
+        }
+    return stats
+
+
 def makeSession(db_name: DbName):
-    return sessionmaker(bind=makeEngine(db_name))()
+    return _sessionMaker(db_name)()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#                                   Единица работы в рамках запроса Flask / задачи Celery
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def _currentScope():
+    """
+    Идентификатор текущей единицы работы: контекст приложения Flask или выполняемая задача Celery
+
+    :return: идентификатор области видимости сессии или None, если код выполняется вне запроса и задачи
+    """
+    if has_app_context():
+        return 'flask', id(_app_ctx_stack.top)
+    if current_task and current_task.request.id:
+        return 'celery', current_task.request.id
+    return None
+
+
+def _scopedRegistry(db_name: DbName) -> scoped_session:
+    registry = _scoped_sessions.get(db_name)
+    if registry is None:
+        with _engines_lock:
+            registry = _scoped_sessions.get(db_name)
+            if registry is None:
+                registry = scoped_session(lambda: makeSession(db_name), scopefunc=_currentScope)
+                _scoped_sessions[db_name] = registry
+    return registry
+
+
+def scopedSession(db_name: DbName):
+    """
+    Сессия текущего запроса или задачи. Все вызовы в рамках одной единицы работы получают один и тот же объект
+
+    :param db_name: имя БД
+    :return: сессия sql alchemy или None, если код выполняется вне запроса и задачи
+    """
+    if _currentScope() is None:
+        return None
+    return _scopedRegistry(db_name)()
+
+
+def removeScopedSessions(commit: bool = True):
+    """
+    Завершение единицы работы: фиксация (или откат) и закрытие всех сессий текущего запроса или задачи
+
+    :param commit: фиксировать изменения, иначе откатить
+    """
+    if _currentScope() is None:
+        return
+    for registry in list(_scoped_sessions.values()):
+        if not registry.registry.has():
+            continue
+        ses = registry()
+        try:
+            if commit:
+                ses.commit()
+            else:
+                ses.rollback()
+        except Exception:
+            ses.rollback()
+            raise
+        finally:
+            registry.remove()
+
+
+def registerSessionTeardown(app):
+    """
+    Подключение завершения единицы работы к окончанию каждого запроса приложения Flask.
+    Изменения фиксируются только для успешного ответа: flask_restful превращает ошибки обработчиков и abort()
+    в ответы 4xx/5xx, и teardown в этом случае получает exc=None
+
+    :param app: приложение Flask
+    """
+    @app.after_request
+    def remember_status(response):
+        g.session_response_status = response.status_code
+        return response
+
+    @app.teardown_appcontext
+    def teardown_sessions(exc):
+        # контекст приложения вне запроса (скрипты, команды) статуса ответа не имеет
+        status = g.pop('session_response_status', None)
+        removeScopedSessions(commit=exc is None and (status is None or status < 400))
 
 
 @contextmanager
 def Session(db_name: DbName):
+    ses = scopedSession(db_name)
+    if ses is not None:
+        # сессией владеет запрос/задача, она будет закрыта при их завершении
+        yield ses
+        return
+
     ses = makeSession(db_name)
     try:
         yield ses
@@ -38,11 +251,7 @@ def withSession(db_name: DbName):
     def withSessionDecorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            SQLSession = makeSession(db_name)
-            try:
-                res = func(SQLSession, *args, **kwargs)
-            finally:
-                SQLSession.close()
-            return res
+            with Session(db_name) as SQLSession:
+                return func(SQLSession, *args, **kwargs)
         return wrapper
     return withSessionDecorator
@@ -0,0 +1,54 @@
+from sqlalchemy.orm import joinedload, selectinload
+
+from DB.models import Transactions, TransactionStatus, TransactionTypes, Franchise, FranchiseBroker, User
+
+
+# именованные профили загрузки связей: вызывающий код сам выбирает, какие связи нужны
+PROFILES = {
+    Transactions: {
+        # только столбцы транзакции
+        'bare': (),
+        # история статусов с описанием (отдельным запросом, без размножения строк транзакции)
+        'with_status_history': (
+            selectinload(Transactions.statuses).joinedload(TransactionStatus.status),
+        ),
+        # все связи транзакции
+        'full': (
+            joinedload(Transactions.type).joinedload(TransactionTypes.unit),
+            joinedload(Transactions.object),
+            selectinload(Transactions.statuses).joinedload(TransactionStatus.status),
+        ),
+    },
+    Franchise: {
+        'bare': (),
+        'with_employees': (
+            selectinload(Franchise.employees).selectinload(User.department),
+        ),
+        'with_agreements': (
+            selectinload(Franchise.agreements).joinedload(FranchiseBroker.broker),
+        ),
+    },
+    User: {
+        'bare': (),
+        'with_departments': (
+            selectinload(User.department),
+            selectinload(User.franchise),
+        ),
+    },
+}
+
+
+def query_profile(ses, model, profile: str = 'bare'):
+    """
+    Запрос модели с заданным профилем загрузки связей
+
+    :param ses: сессия sql alchemy
+    :param model: модель
+    :param profile: имя профиля загрузки
+    :return: объект запроса
+    """
+    try:
+        options = PROFILES[model][profile]
+    except KeyError:
+        raise ValueError(f'Профиль загрузки {profile} для {model.__name__} не найден')
+    return ses.query(model).options(*options)
@@ -0,0 +1,160 @@
+from functools import lru_cache
+from typing import List
+
+import click
+from sqlalchemy import text
+
+from DB.connections import getEngine, DbName
+from Logger import get_logger
+
+Logger = get_logger('migrations', 'migrations')
+
+# изменения схемы поверх исходной: идентификатор, БД и выполняемые команды.
+# Применяются командой flask migrate до запуска новой версии, приложение во время работы DDL не выполняет
+MIGRATIONS = (
+    ('0001_batch_stats', DbName.CORE, (
+        'ALTER TABLE log.batch ADD COLUMN IF NOT EXISTS stats json',
+    )),
+    ('0002_catalog_record_hash', DbName.CORE, (
+        'ALTER TABLE product.shop_prorabam ADD COLUMN IF NOT EXISTS record_hash varchar(32)',
+        'CREATE INDEX IF NOT EXISTS ix_shop_prorabam_src_product_code ON product.shop_prorabam (src_product_code)',
+    )),
+    ('0003_life_pay_receipts', DbName.CORE, (
+        '''CREATE TABLE IF NOT EXISTS log.life_pay_receipts (
+            uuid varchar(64) PRIMARY KEY,
+            merchant varchar(64),
+            number varchar(64),
+            type varchar(32),
+            status varchar(32),
+            amount float8,
+            order_id varchar(64),
+            ofd_url varchar(1024),
+            created timestamp,
+            loaded_date timestamp
+        )''',
+    )),
+    # частичные индексы текущих записей таблиц истории (DB.temporal), условие совпадает с OPEN_END
+    ('0004_history_current_indexes', DbName.CORE, (
+        'CREATE INDEX IF NOT EXISTS ix_certificate_status_current ON business_entity.certificate_status '
+        '(certificate_code) WHERE date_end = \'9999-12-31 23:59:59\'',
+        'CREATE INDEX IF NOT EXISTS ix_franchise_x_status_current ON public.franchise_x_status '
+        '(franchise_id) WHERE date_end = \'9999-12-31\'',
+        'CREATE INDEX IF NOT EXISTS ix_participants_x_object_current ON relation.participants_x_object '
+        '(object_id, department_id) WHERE date_end = \'9999-12-31 23:59:59\'',
+    )),
+    # загрузка заказов 1С (Services.orders_import) обновляет заказ по номеру через ON CONFLICT,
+    # из повторов номера остаётся последняя добавленная строка
+    ('0005_orders_order_code_unique', DbName.CORE, (
+        'DELETE FROM shop_prorabam.orders o USING shop_prorabam.orders d '
+        'WHERE o.order_code = d.order_code AND o.order_id < d.order_id',
+        'CREATE UNIQUE INDEX IF NOT EXISTS ux_orders_order_code ON shop_prorabam.orders (order_code)',
+    )),
+    ('0006_yookassa_notifications', DbName.CORE, (
+        '''CREATE TABLE IF NOT EXISTS log.yookassa_notifications (
+            notification_id serial PRIMARY KEY,
+            dedup_key varchar(128) NOT NULL UNIQUE,
+            payment_id varchar(64),
+            event varchar(64),
+            merchant varchar(64),
+            transaction_id varchar(64),
+            payload json,
+            received_date timestamp,
+            processed_date timestamp,
+            attempts integer DEFAULT 0,
+            error varchar
+        )''',
+    )),
+    ('0007_acquiring_report_watermarks', DbName.CORE, (
+        '''CREATE TABLE IF NOT EXISTS log.acquiring_report_watermarks (
+            report_group varchar(32) PRIMARY KEY,
+            received timestamp,
+            report_id varchar(64),
+            updated_date timestamp
+        )''',
+    )),
+)
+
+MIGRATIONS_DDL = '''
+CREATE TABLE IF NOT EXISTS log.schema_migrations (
+    migration_id varchar(64) PRIMARY KEY,
+    applied_date timestamp NOT NULL DEFAULT now()
+)
+'''
+
+# блокировка, исключающая одновременное применение миграций несколькими процессами
+MIGRATIONS_LOCK = 'SELECT pg_advisory_lock(hashtext(\'log.schema_migrations\'))'
+MIGRATIONS_UNLOCK = 'SELECT pg_advisory_unlock(hashtext(\'log.schema_migrations\'))'
+
+
+def _applied(conn) -> set:
+    exists = conn.execute(text("SELECT to_regclass('log.schema_migrations')")).scalar()
+    if not exists:
+        return set()
+    return set(conn.execute(text('SELECT migration_id FROM log.schema_migrations')).scalars())
+
+
+def pendingMigrations(db_name: DbName = DbName.CORE) -> List[str]:
+    """
+    Миграции БД, ещё не применённые к ней
+
+    :param db_name: имя БД
+    :return: идентификаторы миграций в порядке применения
+    """
+    with getEngine(db_name).connect() as conn:
+        applied = _applied(conn)
+    return [migration_id for migration_id, db, _ in MIGRATIONS if db == db_name and migration_id not in applied]
+
+
+def migrate(db_name: DbName = DbName.CORE) -> List[str]:
+    """
+    Применение ещё не применённых миграций БД. Каждая миграция выполняется в своей транзакции
+    вместе с отметкой о применении
+
+    :param db_name: имя БД
+    :return: идентификаторы применённых миграций
+    """
+    done = []
+    with getEngine(db_name).connect() as conn:
+        conn.execute(text(MIGRATIONS_LOCK))
+        try:
+            with conn.begin():
+                conn.execute(text(MIGRATIONS_DDL))
+            applied = _applied(conn)
+            for migration_id, db, statements in MIGRATIONS:
+                if db != db_name or migration_id in applied:
+                    continue
+                with conn.begin():
+                    for statement in statements:
+                        conn.execute(text(statement))
+                    conn.execute(text('INSERT INTO log.schema_migrations (migration_id) VALUES (:migration_id)'),
+                                 {'migration_id': migration_id})
+                Logger.info(f'{db_name.value}: применена миграция {migration_id}')
+                done.append(migration_id)
+        finally:
+            conn.execute(text(MIGRATIONS_UNLOCK))
+    return done
+
+
+@lru_cache(maxsize=None)
+def requireMigrations(db_name: DbName, *migration_ids: str):
+    """
+    Проверка, что миграции, от которых зависит код, применены к БД (успешная проверка запоминается на процесс)
+
+    :param db_name: имя БД
+    :param migration_ids: идентификаторы миграций
+    :raise: RuntimeError, если какая-либо из миграций не применена
+    """
+    missing = set(migration_ids) & set(pendingMigrations(db_name))
+    if missing:
+        raise RuntimeError(f'{db_name.value}: не применены миграции {", ".join(sorted(missing))}, '
+                           f'выполните flask migrate')
+
+
+@click.command('migrate')
+def migrate_command():
+    """
+    Применение миграций схемы ко всем БД
+    """
+    for db_name in dict.fromkeys(db for _, db, _ in MIGRATIONS):
+        done = migrate(db_name)
+        click.echo(f'{db_name.value}: применено миграций {len(done)}')
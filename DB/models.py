@@ -78,8 +78,8 @@ class Franchise(Base, SerializerMixin):
     legal_status = db.Column(db.String(2))
     is_active = db.Column(db.Boolean)
     franchise_type = db.Column(db.String(64))
-    employees = relationship('User', secondary=FranchiseEmployees, back_populates='franchise', lazy='joined')
-    agreements = relationship('FranchiseBroker', foreign_keys='FranchiseBroker.franchise_id', lazy='joined')
+    employees = relationship('User', secondary=FranchiseEmployees, back_populates='franchise', lazy='select')
+    agreements = relationship('FranchiseBroker', foreign_keys='FranchiseBroker.franchise_id', lazy='select')
     street = db.Column(db.String)
     home_number = db.Column(db.String)
     room_type = db.Column(db.String)
@@ -147,7 +147,7 @@ class Department(Base):
     department_code = db.Column(db.String(64))
     rus_code = db.Column(db.String(16))
     users = relationship('User', secondary=UserDepartament, back_populates='department', single_parent=True,
-                         lazy=False)
+                         lazy='select')
 
 
 class User(Base, SerializerMixin):
@@ -175,8 +175,8 @@ class User(Base, SerializerMixin):
     telegram_id = db.Column(db.Integer)
     alias = db.Column(db.String(10))
     photo_url = db.Column(db.String(256))
-    department = relationship('Department', secondary=UserDepartament, back_populates='users', lazy=False)
-    franchise = relationship('Franchise', secondary=FranchiseEmployees, back_populates='employees', lazy=False)
+    department = relationship('Department', secondary=UserDepartament, back_populates='users', lazy='select')
+    franchise = relationship('Franchise', secondary=FranchiseEmployees, back_populates='employees', lazy='select')
 
 
 class Deals(Base):
@@ -196,6 +196,58 @@ class Deals(Base):
     updated_date = db.Column(db.TIMESTAMP, nullable=False, default=getData)
 
 
+class YookassaNotification(Base):
+    """
+    Журнал входящих уведомлений Yookassa (сырое тело для асинхронной обработки и повторного запуска)
+    """
+    __tablename__ = 'yookassa_notifications'
+    __table_args__ = {'schema': 'log'}
+
+    notification_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    dedup_key = db.Column(db.String(128), nullable=False, unique=True)
+    payment_id = db.Column(db.String(64))
+    event = db.Column(db.String(64))
+    merchant = db.Column(db.String(64))
+    transaction_id = db.Column(db.String(64))
+    payload = db.Column(db.JSON)
+    received_date = db.Column(db.TIMESTAMP, default=getData)
+    processed_date = db.Column(db.TIMESTAMP)
+    attempts = db.Column(db.Integer, default=0)
+    error = db.Column(db.String)
+
+
+class AcquiringReportWatermark(Base):
+    """
+    Отметка последнего обработанного отчёта эквайринга по группе отчётов
+    """
+    __tablename__ = 'acquiring_report_watermarks'
+    __table_args__ = {'schema': 'log'}
+
+    report_group = db.Column(db.String(32), primary_key=True)
+    received = db.Column(db.TIMESTAMP)
+    report_id = db.Column(db.String(64))
+    updated_date = db.Column(db.TIMESTAMP, default=getData)
+
+
+class LifePayReceiptStaging(Base):
+    """
+    Промежуточная таблица чеков LifePay для сверки с транзакциями (Transactions.receipt)
+    """
+    __tablename__ = 'life_pay_receipts'
+    __table_args__ = {'schema': 'log'}
+
+    uuid = db.Column(db.String(64), primary_key=True)
+    merchant = db.Column(db.String(64))
+    number = db.Column(db.String(64))
+    type = db.Column(db.String(32))
+    status = db.Column(db.String(32))
+    amount = db.Column(db.Float)
+    order_id = db.Column(db.String(64))
+    ofd_url = db.Column(db.String(1024))
+    created = db.Column(db.TIMESTAMP)
+    loaded_date = db.Column(db.TIMESTAMP, default=getData)
+
+
 class ReportAcquiring(Base):
     """
     Таблица для отчётов эквайринга
@@ -269,10 +321,10 @@ class Transactions(Base, SerializerMixin):
     receipt = db.Column(db.String)
     comment = db.Column(db.String(512))
     franchise_id = db.Column(db.Integer)
-    # связи
-    type = relationship('TransactionTypes', lazy='joined')
-    statuses = relationship('TransactionStatus', lazy='joined')
-    object = relationship('EstimateObjects', lazy='joined')
+    # связи (загружаются по требованию, жадная загрузка задаётся профилем из DB.loading)
+    type = relationship('TransactionTypes', lazy='select')
+    statuses = relationship('TransactionStatus', lazy='select')
+    object = relationship('EstimateObjects', lazy='select')
 
 
 class TransactionStatus(Base, SerializerMixin):
@@ -292,7 +344,7 @@ class TransactionStatus(Base, SerializerMixin):
     start_date = db.Column(db.TIMESTAMP, default=getData, primary_key=True)
     end_date = db.Column(db.TIMESTAMP, default=getData(datetime.max))
     status_code = db.Column(db.String(64), db.ForeignKey('dimension.transaction_status.status_code'), primary_key=True)
-    status = relationship('TransactionStatusDimensions', lazy='joined')
+    status = relationship('TransactionStatusDimensions', lazy='select')
 
 
 class TransactionStatusDimensions(Base, SerializerMixin):
@@ -328,7 +380,7 @@ class TransactionTypes(Base, SerializerMixin):
     transaction_category = db.Column(db.String(64))
     unit_code = db.Column(db.String(8), db.ForeignKey('public.unit.unit_code'))
     # связи
-    unit = relationship('Units', lazy='joined')
+    unit = relationship('Units', lazy='select')
 
 
 class Units(Base, SerializerMixin):
@@ -489,6 +541,11 @@ class CertificateVersion(Base):
     updated_by = db.Column(db.Integer)
 
 
+# формат номера заказа: префикс и значение последовательности
+ORDER_ID_PREFIX = 'П-'
+ORDER_ID_SEQUENCE = 'generator_id.order_id_seq'
+
+
 class GeneratorOrder(Base):
     __tablename__ = 'order'
     __table_args__ = {'schema': 'generator_id'}
@@ -496,7 +553,7 @@ class GeneratorOrder(Base):
         db.String(32),
         primary_key=True,
         nullable=False,
-        server_default="'П-'::text || nextval('generator_id.order_id_seq'::regclass"
+        server_default=f"'{ORDER_ID_PREFIX}'::text || nextval('{ORDER_ID_SEQUENCE}'::regclass)"
     )
 
 
@@ -561,7 +618,7 @@ class FranchiseBroker(Base, SerializerMixin):
     document_num = db.Column(db.String)
     document_date = db.Column(db.Date)
     documentation_id = db.Column(db.String, db.ForeignKey('business_entity.documents_info.documentation_id'))
-    broker = relationship('Franchise', primaryjoin="Franchise.franchise_id == FranchiseBroker.broker_id", lazy='joined')
+    broker = relationship('Franchise', primaryjoin="Franchise.franchise_id == FranchiseBroker.broker_id", lazy='select')
 
     @property
     def broker_name(self):
@@ -778,6 +835,7 @@ class Batch(Base):
     date_start = db.Column(db.TIMESTAMP, default=getData)
     date_end = db.Column(db.TIMESTAMP)
     business_entity = db.Column(db.String())
+    stats = db.Column(db.JSON)
 
 
 class Orders(Base):
@@ -869,7 +927,8 @@ class Product(Base):
     """
 
     __tablename__ = 'shop_prorabam'
-    __table_args__ = {'schema': 'product'}
+    __table_args__ = (db.Index('ix_shop_prorabam_src_product_code', 'src_product_code'),
+                      {'schema': 'product'})
 
     product_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     batch_id = db.Column(db.Integer)
@@ -880,3 +939,5 @@ class Product(Base):
     description = db.Column(db.String(1024))
     src_product_code = db.Column(db.String(256))
     vendor_code = db.Column(db.String(64))
+    # хэш полей записи 1С для определения изменений при синхронизации
+    record_hash = db.Column(db.String(32))
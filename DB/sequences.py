@@ -0,0 +1,46 @@
+import os
+from collections import deque
+from threading import Lock
+
+from sqlalchemy import text
+
+from Config import configs
+from DB.models import ORDER_ID_SEQUENCE
+
+
+class SequenceBlockAllocator:
+    """
+    Выдача значений последовательности Postgres из памяти процесса. Значения резервируются блоками
+    одним запросом nextval, поэтому уникальны для всех процессов (воркеры Flask, процессы Celery).
+    В пределах процесса значения возрастают, между процессами при block_size > 1 порядок выдачи
+    не совпадает с порядком значений: процесс с более ранним блоком выдаёт меньшие значения позже.
+    Где важен сквозной порядок, нужен block_size = 1 (nextval на каждое значение, без записи и фиксации).
+    Неиспользованный остаток блока при завершении процесса пропускается
+    """
+
+    def __init__(self, sequence: str, block_size: int = 50):
+        self.block_size = block_size
+        self._stmt = text(f"SELECT nextval('{sequence}') FROM generate_series(1, :size)")
+        self._values = deque()
+        self._pid = None
+        self._lock = Lock()
+
+    def next(self, ses) -> int:
+        """
+        Следующее значение последовательности
+
+        :param ses: сессия sql alchemy (используется только для резервирования блока, без фиксации)
+        :return: значение последовательности
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                # блок родительского процесса после fork выдавался бы повторно
+                self._values.clear()
+                self._pid = os.getpid()
+            if not self._values:
+                self._values.extend(sorted(ses.execute(self._stmt, {'size': self.block_size}).scalars()))
+            return self._values.popleft()
+
+
+order_id_allocator = SequenceBlockAllocator(ORDER_ID_SEQUENCE,
+                                            block_size=(configs.get('order_id') or {}).get('block_size', 50))
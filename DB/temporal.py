@@ -0,0 +1,70 @@
+from datetime import datetime
+from typing import Sequence
+
+from sqlalchemy import insert, literal, select, update
+
+from DB.models import CertificateStatus, FranchiseXStatus, ParticipantsXObject, getData
+
+# открытая запись истории (текущее состояние)
+OPEN_END = getData(datetime.max)
+
+
+class TemporalTable:
+    """
+    Таблица истории с интервалами действия записей (date_start, date_end). Текущая запись имеет открытую
+    дату окончания, чтение текущего состояния обслуживается частичным индексом по открытым записям
+    (миграция 0004_history_current_indexes), поэтому не зависит от объёма истории
+    """
+
+    def __init__(self, model, key: Sequence[str]):
+        """
+        :param model: модель таблицы истории
+        :param key: поля сущности, для которой ведётся история
+        """
+        self.model = model
+        self.key = tuple(key)
+
+    def _key_columns(self) -> list:
+        return [getattr(self.model, name) for name in self.key]
+
+    def is_current(self):
+        """
+        Условие отбора текущих записей (для фильтров и условий соединения)
+        """
+        return self.model.date_end == OPEN_END
+
+    def current(self, ses, **key):
+        """
+        Запрос текущей записи сущности
+
+        :param ses: сессия sql alchemy
+        :param key: значения полей сущности
+        :return: запрос sql alchemy
+        """
+        return ses.query(self.model).filter_by(**key).filter(self.is_current())
+
+    def transition(self, ses, values: dict, at=None):
+        """
+        Смена состояния одним запросом: закрытие текущей записи и добавление новой (UPDATE в CTE и INSERT)
+
+        :param ses: сессия sql alchemy
+        :param values: поля новой записи, включая поля сущности
+        :param at: момент смены состояния (по умолчанию текущее время)
+        """
+        at = at or getData()
+        key = {name: values[name] for name in self.key}
+        values = {**values, 'date_start': values.get('date_start') or at, 'date_end': OPEN_END}
+
+        closed = update(self.model). \
+            where(*(column == key[name] for name, column in zip(self.key, self._key_columns())), self.is_current()). \
+            values(date_end=at). \
+            returning(self.model.date_end). \
+            cte('closed')
+        row = select(*(literal(value, getattr(self.model, name).type) for name, value in values.items()))
+        stmt = insert(self.model).from_select(list(values), row).add_cte(closed)
+        ses.execute(stmt)
+
+
+certificate_status_history = TemporalTable(CertificateStatus, ('certificate_code',))
+franchise_status_history = TemporalTable(FranchiseXStatus, ('franchise_id',))
+participants_history = TemporalTable(ParticipantsXObject, ('object_id', 'department_id'))
@@ -1,34 +1,84 @@
 import logging
 import os.path
 
-from logging.handlers import TimedRotatingFileHandler
+from functools import lru_cache
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
+from queue import SimpleQueue
+from threading import Lock
 
 from Config import configs
 
 
 ff = logging.Formatter(fmt='%(asctime)s [%(levelname)s] %(name)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 
+_handlers_lock = Lock()
 
+
+class AsyncFileHandler(QueueHandler):
+    """
+    Обработчик, который только ставит записи в очередь. Запись в файл выполняет один фоновый поток на файл,
+    поэтому потоки запросов не ждут файловых операций
+    """
+
+    def __init__(self, file_name: str):
+        super().__init__(SimpleQueue())
+        self.file_name = file_name
+        self._listener = None
+        self._pid = None
+        self._start()
+
+    def _start(self):
+        fh = TimedRotatingFileHandler(os.path.join(configs.get("logs").get("path"), self.file_name),
+                                      when='D',
+                                      interval=1,
+                                      backupCount=30,
+                                      encoding='utf-8',
+                                      delay=True)
+        fh.setFormatter(ff)
+        self.queue = SimpleQueue()
+        self._listener = QueueListener(self.queue, fh)
+        self._listener.start()
+        self._pid = os.getpid()
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            # поток записи не переживает fork (prefork Celery, воркеры gunicorn) - запускаем заново
+            with _handlers_lock:
+                if self._pid != os.getpid():
+                    self._start()
+        super().enqueue(record)
+
+    def close(self):
+        if self._listener and self._pid == os.getpid():
+            # дописываем накопленные в очереди записи
+            self._listener.stop()
+            for handler in self._listener.handlers:
+                handler.close()
+        self._listener = None
+        super().close()
+
+
+@lru_cache(maxsize=None)
+def _get_file_handler(file_name: str) -> AsyncFileHandler:
+    return AsyncFileHandler(file_name)
+
+
+@lru_cache(maxsize=None)
 def get_logger(name: str, file_name: str, level: int = logging.INFO):
     """
-    Функция формирует объект логировщика для записи данных о работе приложения в файл
+    Функция формирует объект логировщика для записи данных о работе приложения в файл.
+    Логировщик и обработчик файла создаются один раз и переиспользуются при повторных вызовах
 
     :param name: имя логировщика
     :param file_name: имя файла, в который будут записываться логи
     :param level: уровень записи информации
     :return: объект логировщика
     """
-    fh = TimedRotatingFileHandler(os.path.join(configs.get("logs").get("path"), file_name),
-                                  when='D',
-                                  interval=1,
-                                  backupCount=30,
-                                  encoding='utf-8',
-                                  delay=True)
-    fh.setLevel(level)
-    fh.setFormatter(ff)
     logger = logging.getLogger(name)
     logger.setLevel(level)
     if not logger.handlers:
+        with _handlers_lock:
+            fh = _get_file_handler(file_name)
         logger.addHandler(fh)
 
     return logger
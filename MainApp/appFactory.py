@@ -1,23 +1,65 @@
-from time import sleep
+from functools import lru_cache
 from os import path
-from flask import Flask
+from flask import Flask, request
 from flask_cors import CORS
-from swagger_ui import api_doc
+from sentry_sdk.integrations.flask import FlaskIntegration
 from AuthManager import AuthManager
 
-from API.common import resp
-from MainApp import clear_cache
-from TelegramBot.dialog import bot
+from API.common import resp, plain_resp
+from DB import registerSessionTeardown
+from DB.migrations import migrate_command
+from Metrics import instrument_app, register_queue_depth, render_metrics, init_sentry
+from MainApp import file_cache, celery_config
 
 from Config import configs
 
 
-def create_app():
+@lru_cache(maxsize=None)
+def _docs_app() -> Flask:
+    # документация собирается при первом обращении: разбор swagger.yaml не входит в запуск воркера
+    from swagger_ui import api_doc
+
+    docs = Flask('api_doc')
+    config_path = path.join(path.dirname(path.abspath(__file__)), 'swagger.yaml')
+    api_doc(docs,
+            config_path=config_path,
+            url_prefix="/api/doc",
+            title="swagger",
+            editor=True)
+    return docs
+
+
+def api_doc_endpoint(**_kwargs):
+    docs = _docs_app()
+    with docs.request_context(request.environ):
+        return docs.full_dispatch_request()
+
+
+def create_app(preload: bool = None):
+    """
+    Создание приложения
+
+    :param preload: режим предзагрузки (приложение создаётся в главном процессе сервера до fork воркеров):
+        сборка документации выполняется один раз. По умолчанию берётся из flask.preload
+    """
+    if preload is None:
+        preload = bool(configs.get('flask').get('preload'))
+
     app = Flask(__name__)
     app.config['SECRET_KEY'] = configs.get('flask').get('secret')
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = True
     app.config['JSON_AS_ASCII'] = False
 
+    # трассировка запросов в Sentry с адаптивным отбором транзакций
+    init_sentry(FlaskIntegration(transaction_style='url'))
+    # одна сессия БД на запрос, фиксация/откат при его завершении
+    registerSessionTeardown(app)
+    # изменения схемы БД применяются командой flask migrate
+    app.cli.add_command(migrate_command)
+    # метрики Prometheus: время запросов, пулы БД, длина очередей Celery
+    instrument_app(app)
+    register_queue_depth(celery_config.broker_url, ('identification', 'celery'))
+
     CORS(app,
          resourses={r"services/api*": {"origin": configs.get('cors').get('origins').split(';')}},
          supports_credentials=True)
@@ -38,11 +80,10 @@ def create_app():
     bot_token = configs.get('telegram_bot_trans').get('token')
     url_bot = f'/bot/{bot_token}'
     if bot_token:
-        base_address = configs.get('telegram_bot_trans').get('base_proxy_notify_address')
-        # bot.remove_webhook()
-        # sleep(1)
-        # _ = bot.set_webhook(url=f'{base_address}/{bot_token}')
-    clear_cache()
+        # импорт регистрирует обработчики диалогов бота; без токена бот не используется
+        import TelegramBot.dialog  # noqa: F401
+    # кэш файлов общий для воркеров и сохраняется между перезапусками, устаревшие файлы удаляет evict_cache_task
+    file_cache.ensure()
     # белый список адресов без аутентификации
     white_url_list = ('static', '/sber/callback/', url_bot, '/bot/responder',
                       '/lifepay/callback/', '/mandarin/callback/', '/api/doc',
@@ -58,13 +99,18 @@ def create_app():
     auth_manager.config['AUTH_URL'] = configs.get("auth").get("url")
     auth_manager.config['REDIRECT_DOMAIN'] = configs.get('domain').get('url')
 
-    # подключаем файл с документацией
-    config_path = path.join(path.dirname(path.abspath(__file__)), 'swagger.yaml')
-    api_doc(app,
-            config_path=config_path,
-            url_prefix="/api/doc",
-            title="swagger",
-            editor=True)
+    # подключаем файл с документацией (собирается при первом обращении или при предзагрузке)
+    app.add_url_rule('/api/doc', 'api_doc', api_doc_endpoint)
+    app.add_url_rule('/api/doc/', 'api_doc_index', api_doc_endpoint)
+    app.add_url_rule('/api/doc/<path:_path>', 'api_doc_files', api_doc_endpoint)
+    if preload:
+        _docs_app()
+
+    # метрики отдаются только аутентифицированным клиентам (адрес не входит в белый список)
+    @app.route("/metrics")
+    def metrics_endpoint():
+        data, content_type = render_metrics()
+        return plain_resp(data, 200, {'Content-Type': content_type})
 
     @app.route("/sitemap")
     def sitemap_endpoint():
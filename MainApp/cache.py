@@ -0,0 +1,176 @@
+import hashlib
+import os
+import tempfile
+from time import time
+from typing import Optional, Callable, Iterable, Iterator
+
+from Config import configs
+from Logger import get_logger
+
+Logger = get_logger('file_cache', 'file_cache')
+
+# незавершённые временные файлы старше этого возраста (с) считаются брошенными
+STALE_TMP_AGE = 3600
+TMP_SUFFIX = '.tmp'
+
+
+class FileCache:
+    """
+    Общий для всех процессов дисковый кэш файлов (выгрузки Excel). Ключ файла - хэш его параметров,
+    запись выполняется во временный файл с атомарным переименованием, поэтому читатели не видят
+    недописанных файлов. Каталог кэша при запуске не очищается. Время последнего обращения хранится
+    в atime файла (обновляется при чтении через get), вытеснение по TTL и ограничению размера
+    выполняет периодическая задача (evict)
+    """
+
+    def __init__(self, base_path: str, base_uri: str, max_size: int, ttl: float, subdirectories: Iterable[str] = ()):
+        """
+        :param base_path: каталог кэша
+        :param base_uri: адрес каталога кэша для ссылок на файлы
+        :param max_size: максимальный размер кэша (байт)
+        :param ttl: время хранения файла с момента записи (с)
+        :param subdirectories: подкаталоги кэша, в которые пишут выгрузки
+        """
+        self.base_path = base_path
+        self.base_uri = base_uri
+        self.max_size = max_size
+        self.ttl = ttl
+        self.subdirectories = tuple(subdirectories)
+
+    @staticmethod
+    def key(*parts) -> str:
+        """
+        Ключ файла по параметрам его формирования
+
+        :param parts: параметры (тип выгрузки, фильтры, версия данных ...)
+        :return: ключ
+        """
+        return hashlib.sha256('\x1f'.join(map(str, parts)).encode('utf-8')).hexdigest()
+
+    def _relative(self, key: str, suffix: str) -> str:
+        return os.path.join(key[:2], f'{key}{suffix}')
+
+    def path(self, key: str, suffix: str = '') -> str:
+        return os.path.join(self.base_path, self._relative(key, suffix))
+
+    def uri(self, key: str, suffix: str = '') -> str:
+        return os.path.join(self.base_uri, self._relative(key, suffix))
+
+    def ensure(self):
+        """
+        Создание каталога кэша и подкаталогов выгрузок (содержимое не удаляется)
+        """
+        os.makedirs(self.base_path, exist_ok=True)
+        for subdirectory in self.subdirectories:
+            os.makedirs(f'{self.base_path}{os.path.splitdrive(subdirectory)[-1]}', exist_ok=True)
+
+    def get(self, key: str, suffix: str = '') -> Optional[str]:
+        """
+        Путь к файлу в кэше
+
+        :param key: ключ
+        :param suffix: расширение файла
+        :return: путь или None, если файла нет или истёк срок хранения
+        """
+        path = self.path(key, suffix)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        now = time()
+        if stat.st_mtime + self.ttl <= now:
+            return None
+        # atime обновляется явно: файловые системы часто смонтированы с noatime/relatime
+        os.utime(path, (now, stat.st_mtime))
+        return path
+
+    def put(self, key: str, write: Callable, suffix: str = '') -> str:
+        """
+        Запись файла в кэш
+
+        :param key: ключ
+        :param write: функция записи, получает путь временного файла
+        :param suffix: расширение файла
+        :return: путь к файлу в кэше
+        """
+        path = self.path(key, suffix)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix=TMP_SUFFIX, dir=os.path.dirname(path))
+        os.close(fd)
+        try:
+            write(tmp_path)
+            # mkstemp создаёт файл с правами 0600, файлы кэша раздаются как статика
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return path
+
+    def get_or_create(self, key: str, write: Callable, suffix: str = '') -> str:
+        """
+        Путь к файлу в кэше, при отсутствии файл формируется функцией write
+
+        :param key: ключ
+        :param write: функция записи, получает путь временного файла
+        :param suffix: расширение файла
+        :return: путь к файлу в кэше
+        """
+        return self.get(key, suffix) or self.put(key, write, suffix)
+
+    def _files(self) -> Iterator[tuple]:
+        for directory, _, files in os.walk(self.base_path):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    yield path, os.stat(path)
+                except FileNotFoundError:
+                    continue
+
+    def evict(self) -> dict:
+        """
+        Удаление файлов с истёкшим сроком хранения, брошенных временных файлов и давно не используемых
+        файлов сверх ограничения размера
+
+        :return: количество удалённых файлов и освобождённый объём
+        """
+        now = time()
+        removed, freed, kept = 0, 0, []
+        for path, stat in self._files():
+            if path.endswith(TMP_SUFFIX):
+                expired = stat.st_mtime + STALE_TMP_AGE <= now
+            else:
+                expired = stat.st_mtime + self.ttl <= now
+            if not expired:
+                kept.append((stat.st_atime, stat.st_size, path))
+                continue
+            if self._remove(path):
+                removed, freed = removed + 1, freed + stat.st_size
+
+        total = sum(size for _, size, _ in kept)
+        for _, size, path in sorted(kept):
+            if total <= self.max_size:
+                break
+            if not path.endswith(TMP_SUFFIX) and self._remove(path):
+                removed, freed = removed + 1, freed + size
+                total -= size
+
+        Logger.info(f'Кэш {self.base_path}: удалено файлов {removed}, освобождено {freed} байт, занято {total} байт')
+        return {'removed': removed, 'freed': freed, 'size': total}
+
+    @staticmethod
+    def _remove(path: str) -> bool:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+
+_cache_cfg = configs.get('cache') or {}
+file_cache = FileCache(base_path=_cache_cfg.get('base_path'),
+                       base_uri=_cache_cfg.get('base_uri'),
+                       max_size=_cache_cfg.get('max_size_mb', 1024) * 1024 * 1024,
+                       ttl=_cache_cfg.get('ttl', 86400),
+                       subdirectories=[path for path in ((configs.get('downloads') or {}).get('excel'),) if path])
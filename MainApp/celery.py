@@ -1,25 +1,60 @@
-import sentry_sdk
+import os
+from time import perf_counter
+
 from celery import Celery, signals
 from sentry_sdk.integrations.celery import CeleryIntegration
 
 from Config import configs
+from DB import disposeEngines, removeScopedSessions
+from Metrics import TASK_DURATION, observe_db_pool, mark_process_dead, start_metrics_server, init_sentry
 
 app = Celery('MainApp')
 
 
 @signals.celeryd_init.connect
-def init_sentry(**_kwargs):
-    if env := configs.get("sentry").get("env"):
-        sentry_sdk.init(
-            dsn=configs.get("sentry").get("dsn"),
-            environment=env,
-            traces_sample_rate=1.0,
-            profiles_sample_rate=1.0,
-            debug=True,
-            integrations=[
-                CeleryIntegration(monitor_beat_tasks=True)
-            ]
-        )
+def init_worker_sentry(**_kwargs):
+    # доли записи транзакций и профилирования задаются в sentry.tracing
+    init_sentry(CeleryIntegration(monitor_beat_tasks=True))
+
+
+@signals.worker_process_init.connect
+def reset_db_pool(**_kwargs):
+    # дочерний процесс prefork не должен использовать соединения, открытые в родителе
+    disposeEngines(close=False)
+
+
+@signals.task_postrun.connect
+def close_db_sessions(state=None, **_kwargs):
+    # одна сессия БД на задачу, фиксация только при успешном выполнении
+    removeScopedSessions(commit=state == 'SUCCESS')
+
+
+_task_started = {}
+
+
+@signals.task_prerun.connect
+def start_task_timer(task_id=None, **_kwargs):
+    _task_started[task_id] = perf_counter()
+
+
+@signals.task_postrun.connect
+def observe_task(task_id=None, task=None, state=None, **_kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        TASK_DURATION.labels(task.name, state or 'UNKNOWN').observe(perf_counter() - started)
+    observe_db_pool()
+
+
+@signals.worker_process_shutdown.connect
+def cleanup_process_metrics(pid=None, **_kwargs):
+    mark_process_dead(pid or os.getpid())
+
+
+@signals.worker_ready.connect
+def serve_worker_metrics(**_kwargs):
+    # метрики воркера отдаются отдельным HTTP сервером главного процесса
+    if port := (configs.get('metrics') or {}).get('celery_port'):
+        start_metrics_server(port)
 
 
 app.config_from_object('MainApp.celery_config')
@@ -27,9 +62,19 @@ app.autodiscover_tasks()
 
 
 app.conf.beat_schedule = {
-   'check_email_acquiring': {
+    'check_email_acquiring': {
         'task': 'API.tasks.get_acquiring_reports_task',
         'schedule': 10800,  # каждые 3 часа
         'args': tuple(),
     },
+    'sync_life_pay_receipts': {
+        'task': 'API.tasks.sync_life_pay_receipts_task',
+        'schedule': (configs.get('life_pay_sync') or {}).get('interval', 3600),
+        'args': tuple(),
+    },
+    'evict_file_cache': {
+        'task': 'API.tasks.evict_cache_task',
+        'schedule': (configs.get('cache') or {}).get('evict_interval', 3600),
+        'args': tuple(),
+    },
 }
@@ -10,9 +10,18 @@ pw_string = f':{RC.get("password")}@' if RC.get("password") else ''
 broker_url = f'redis://{pw_string}{RC.get("host")}:{RC.get("port")}/{RC.get("db")}'
 result_backend = broker_url
 timezone = 'Europe/Moscow'
-imports = ('API.tasks',)
+imports = ('API.tasks', 'Webhooks.Yookassa')
 task_routes = {
     'API.tasks.get_acquiring_reports_task': {
         'queue': 'identification'
     },
+    'API.tasks.fetch_report_group_task': {
+        'queue': 'identification'
+    },
+    'API.tasks.cross_report_task': {
+        'queue': 'identification'
+    },
+    'API.tasks.acquiring_reports_done': {
+        'queue': 'identification'
+    },
 }
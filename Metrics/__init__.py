@@ -0,0 +1,9 @@
+from Metrics.metrics import HTTP_LATENCY, WEBHOOK_DURATION, OUTBOUND_LATENCY, TASK_DURATION, CACHE_REQUESTS, \
+    outbound_call, observe_db_pool, instrument_app, register_queue_depth, render_metrics, start_metrics_server, \
+    mark_process_dead
+from Metrics.tracing import init_sentry, span
+
+
+__all__ = (HTTP_LATENCY, WEBHOOK_DURATION, OUTBOUND_LATENCY, TASK_DURATION, CACHE_REQUESTS, outbound_call,
+           observe_db_pool, instrument_app, register_queue_depth, render_metrics, start_metrics_server,
+           mark_process_dead, init_sentry, span)
@@ -0,0 +1,166 @@
+import os
+from contextlib import contextmanager
+from time import perf_counter
+
+from prometheus_client import Counter, Histogram, Gauge, CollectorRegistry, REGISTRY, generate_latest, multiprocess, \
+    CONTENT_TYPE_LATEST, start_http_server
+from flask import g, request
+from prometheus_client.core import GaugeMetricFamily
+from redis import Redis
+
+from DB import poolStats
+from .tracing import span
+
+# режим нескольких процессов (gunicorn, prefork Celery) включается переменной окружения PROMETHEUS_MULTIPROC_DIR
+MULTIPROCESS = bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR'))
+
+HTTP_LATENCY = Histogram('payments_http_request_duration_seconds',
+                         'Время обработки запроса к API',
+                         ('endpoint', 'method', 'status'))
+WEBHOOK_DURATION = Histogram('payments_webhook_duration_seconds',
+                             'Время обработки уведомлений платёжных сервисов',
+                             ('provider', 'stage', 'outcome'))
+OUTBOUND_LATENCY = Histogram('payments_outbound_request_duration_seconds',
+                             'Время запросов к внешним сервисам',
+                             ('provider', 'operation', 'status'))
+TASK_DURATION = Histogram('payments_celery_task_duration_seconds',
+                          'Время выполнения задач Celery',
+                          ('task', 'state'),
+                          buckets=(.1, .5, 1, 5, 10, 30, 60, 300, 900, 1800, float('inf')))
+CACHE_REQUESTS = Counter('payments_cache_requests_total',
+                         'Обращения к кэшам справочников',
+                         ('cache', 'result'))
+DB_POOL_CONNECTIONS = Gauge('payments_db_pool_connections',
+                            'Состояние пулов соединений с БД',
+                            ('db', 'state'),
+                            multiprocess_mode='livesum')
+
+
+@contextmanager
+def outbound_call(provider: str, operation: str):
+    """
+    Замер запроса к внешнему сервису и спан Sentry. В выданный словарь можно записать код ответа (status)
+
+    :param provider: внешний сервис
+    :param operation: операция
+    """
+    started = perf_counter()
+    call = {'status': 'ok'}
+    try:
+        with span('http.client', f'{provider} {operation}', provider=provider) as current:
+            yield call
+            current.set_tag('http.status', str(call['status']))
+    except Exception as e:
+        if call['status'] == 'ok':
+            call['status'] = e.__class__.__name__
+        raise
+    finally:
+        OUTBOUND_LATENCY.labels(provider, operation, str(call['status'])).observe(perf_counter() - started)
+
+
+def observe_db_pool():
+    """
+    Снимок состояния пулов соединений процесса
+    """
+    for db_name, stats in poolStats().items():
+        for state in ('checked_in', 'checked_out', 'overflow'):
+            DB_POOL_CONNECTIONS.labels(db_name, state).set(stats[state])
+
+
+def instrument_app(app):
+    """
+    Замер времени обработки запросов приложения Flask
+
+    :param app: приложение Flask
+    """
+    @app.before_request
+    def start_request_timer():
+        g.metrics_started = perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            # имя обработчика, а не шаблон адреса: адрес бота содержит токен Telegram
+            endpoint = request.endpoint or 'unknown'
+            HTTP_LATENCY.labels(endpoint, request.method, response.status_code).observe(perf_counter() - started)
+        observe_db_pool()
+        return response
+
+
+class QueueDepthCollector:
+    """
+    Длина очередей Celery в брокере Redis на момент сбора метрик
+    """
+
+    def __init__(self, broker_url: str, queues: tuple):
+        self.broker_url = broker_url
+        self.queues = queues
+        self._redis = None
+
+    def collect(self):
+        metric = GaugeMetricFamily('payments_celery_queue_depth',
+                                   'Количество задач в очереди Celery',
+                                   labels=('queue',))
+        try:
+            self._redis = self._redis or Redis.from_url(self.broker_url)
+            for queue in self.queues:
+                metric.add_metric((queue,), self._redis.llen(queue))
+        except Exception:
+            self._redis = None
+        yield metric
+
+
+_queue_registry = CollectorRegistry()
+_queue_collector = None
+
+
+def register_queue_depth(broker_url: str, queues: tuple):
+    """
+    Подключение сбора длины очередей Celery к выдаче метрик
+
+    :param broker_url: адрес брокера Redis
+    :param queues: имена очередей
+    """
+    global _queue_collector
+
+    if _queue_collector is None:
+        _queue_collector = QueueDepthCollector(broker_url, queues)
+        _queue_registry.register(_queue_collector)
+
+
+def _scrape_registry() -> CollectorRegistry:
+    # в многопроцессном режиме агрегируются данные всех процессов
+    if not MULTIPROCESS:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def render_metrics() -> tuple:
+    """
+    Метрики в текстовом формате Prometheus
+
+    :return: тело ответа и тип содержимого
+    """
+    return generate_latest(_scrape_registry()) + generate_latest(_queue_registry), CONTENT_TYPE_LATEST
+
+
+def start_metrics_server(port: int):
+    """
+    Отдельный HTTP сервер метрик (для процессов без приложения Flask, например воркера Celery)
+
+    :param port: порт сервера
+    """
+    start_http_server(port, registry=_scrape_registry())
+
+
+def mark_process_dead(pid: int):
+    """
+    Очистка данных завершившегося процесса (хук child_exit gunicorn, завершение процесса Celery)
+
+    :param pid: идентификатор процесса
+    """
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,108 @@
+from contextlib import contextmanager
+from datetime import datetime
+from random import random
+from typing import Optional
+
+import sentry_sdk
+from sentry_sdk.integrations.sqlalchemy import SqlalchemyIntegration
+
+from Config import configs
+
+# транзакции служебных адресов не записываются
+IGNORED_TRANSACTIONS = ('/metrics', '/sitemap', '/api/doc', 'static')
+# статусы транзакций, которые отправляются всегда
+ERROR_STATUSES = frozenset({'internal_error', 'unknown_error', 'unavailable', 'deadline_exceeded', 'aborted',
+                            'data_loss'})
+
+
+def _tracing_config() -> dict:
+    return (configs.get('sentry') or {}).get('tracing') or {}
+
+
+def traces_sampler(sampling_context: dict) -> float:
+    """
+    Решение о записи транзакции при её начале. Записываются все транзакции (record_rate, по умолчанию 1),
+    кроме служебных адресов: отбор выполняется перед отправкой (before_send_transaction), когда известны
+    статус и длительность. Решение родительской транзакции (входящий заголовок sentry-trace, задача,
+    поставленная из запроса) наследуется, чтобы трассировка не разрывалась
+
+    :param sampling_context: контекст Sentry (transaction_context, parent_sampled и данные интеграций)
+    :return: вероятность записи транзакции
+    """
+    if sampling_context.get('parent_sampled') is not None:
+        return float(sampling_context['parent_sampled'])
+
+    name = (sampling_context.get('transaction_context') or {}).get('name') or ''
+    if any(ignored in name for ignored in IGNORED_TRANSACTIONS):
+        return 0
+    return _tracing_config().get('record_rate', 1.0)
+
+
+def _timestamp(value) -> Optional[float]:
+    if isinstance(value, datetime):
+        return value.timestamp()
+    if isinstance(value, str):
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    return value
+
+
+def before_send_transaction(event: dict, _hint: dict) -> Optional[dict]:
+    """
+    Отбор записанных транзакций перед отправкой: ошибки и медленные транзакции отправляются всегда,
+    остальные - с вероятностью из rates (по префиксу имени транзакции) или keep_rate
+
+    :param event: транзакция Sentry
+    :return: транзакция или None, если она не отправляется
+    """
+    cfg = _tracing_config()
+    status = ((event.get('contexts') or {}).get('trace') or {}).get('status')
+    if status in ERROR_STATUSES:
+        return event
+
+    started, finished = _timestamp(event.get('start_timestamp')), _timestamp(event.get('timestamp'))
+    if started is not None and finished is not None and finished - started >= cfg.get('slow_threshold', 2):
+        return event
+
+    name = event.get('transaction') or ''
+    keep_rate = next((rate for prefix, rate in (cfg.get('rates') or {}).items() if name.startswith(prefix)),
+                     cfg.get('keep_rate', 0.1))
+    return event if random() < keep_rate else None
+
+
+def init_sentry(*integrations) -> bool:
+    """
+    Подключение Sentry с адаптивным отбором транзакций. Запросы к БД записываются как спаны интеграцией SQLAlchemy
+
+    :param integrations: интеграции процесса (Flask, Celery)
+    :return: True, если Sentry подключен
+    """
+    sentry = configs.get('sentry') or {}
+    if not (env := sentry.get('env')):
+        return False
+
+    sentry_sdk.init(
+        dsn=sentry.get('dsn'),
+        environment=env,
+        traces_sampler=traces_sampler,
+        before_send_transaction=before_send_transaction,
+        # доля профилируемых из записанных транзакций: записываются все, поэтому профилирование выключено
+        profiles_sample_rate=_tracing_config().get('profiles_sample_rate', 0),
+        debug=sentry.get('debug', False),
+        integrations=[*integrations, SqlalchemyIntegration()]
+    )
+    return True
+
+
+@contextmanager
+def span(op: str, description: str = None, **data):
+    """
+    Спан текущей транзакции Sentry. Вне записываемой транзакции ничего не записывается
+
+    :param op: тип операции (http.client, db.query, receipt.create ...)
+    :param description: описание операции
+    :param data: дополнительные данные спана
+    """
+    with sentry_sdk.start_span(op=op, description=description) as current:
+        for key, value in data.items():
+            current.set_data(key, value)
+        yield current
@@ -1,32 +1,68 @@
 import json
 from abc import ABC, abstractmethod
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from itertools import groupby, islice
 from logging import Logger
-from typing import Optional, TypeVar
+from threading import Lock
+from time import monotonic, sleep
+from typing import Optional, TypeVar, Iterable, List, Iterator
+from urllib.parse import urlsplit
+
+import sentry_sdk
+from sqlalchemy.dialects.postgresql import insert
+
 from Logger import get_logger
-from requests import session
 
 from Config import configs
 from DB import Session, DbName, rawRequest
-from DB.models import Transactions, Report, AmoObjects, EstimateObjects
+from DB.connections import makeSession
+from DB.migrations import requireMigrations
+from DB.models import Transactions, Report, AmoObjects, EstimateObjects, LifePayReceiptStaging, getData
 from Services.common import PaymentTypes
 from .common import ServiceError, ServicesType, Merchant, PaymentMethod, PaymentObject, \
     ServiceFactory, LifePayOperationType, get_manual_prepayment, is_nominal_object
+from Metrics import outbound_call, span
+from .directory import franchise_directory
+from .transport import get_transport, HttpTransport
 from AuthManager import RoleEnum
 
 Logger_lifePay = get_logger('lifePay_payload', 'lifePay_payload')
 SelfService = TypeVar('SelfService', bound='Service')
+ReceiptResult = namedtuple('ReceiptResult', ('creator', 'receipt', 'error'))
+TRANSACTIONS_PAGE_LIMIT = 100
+
+
+class LifePayTransaction(namedtuple('LifePayTransaction',
+                                    ('uuid', 'number', 'type', 'status', 'amount', 'order_id', 'ofd_url', 'created',
+                                     'raw'))):
+    """
+    Чек (операция) из списка транзакций LifePay
+    """
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(uuid=data.get('uuid'),
+                   number=data.get('number'),
+                   type=data.get('type'),
+                   status=data.get('status'),
+                   amount=data.get('amount'),
+                   order_id=data.get('ext_id') or data.get('order_id'),
+                   ofd_url=data.get('ofd_url'),
+                   created=data.get('created'),
+                   raw=data)
 
 
 class Service(ServiceFactory):
     __API_URLS = configs.get('life_pay_urls')
     __MERCHANTS = configs.get('life_pay_mto')
+    __HEADERS = {
+        'Content-Type': 'application/json',
+        'charset': 'utf-8',
+    }
 
     def __init__(self, merchant: Merchant = Merchant.DOMEO_MART, with_agent=True):
-        self.__session = session()
-        self.__session.headers.update({
-            'Content-Type': 'application/json',
-            'charset': 'utf-8',
-        })
         self.scheme = None
         self.merchant = merchant
         self.with_agent = with_agent
@@ -51,6 +87,14 @@ class Service(ServiceFactory):
     def __auth_credentials(self) -> dict:
         return self.__MERCHANTS.get(self.merchant.value).get('auth_credentials')
 
+    def __transport(self, url: str) -> HttpTransport:
+        """
+        Общий HTTP клиент процесса для мерчанта и адреса сервиса (соединения переиспользуются между экземплярами)
+        """
+        return get_transport(('life_pay', self.merchant.value, urlsplit(url).netloc),
+                             headers=self.__HEADERS,
+                             config=configs.get('life_pay_http'))
+
     def __send_request(self, payload: Optional[dict], url: str, request_type: str = 'POST') -> dict:
         """
             Отправка запросов к API
@@ -60,24 +104,30 @@ class Service(ServiceFactory):
             :raise: ServiceError
             :return: json ответ от сервиса
         """
-        try:
-            payload = payload | self.__auth_credentials if payload else self.__auth_credentials
-            Logger_lifePay.info(json.dumps(payload))
-            if request_type == 'POST':
-                response = self.__session.post(url, json=payload)
-            elif request_type == 'GET':
-                response = self.__session.get(url, params=payload)
-            else:
-                raise NotImplementedError(f'Метод {request_type} не поддерживается (Возможные варианты GET, POST)')
-
-        except Exception as e:
-            raise ServiceError(f'Connection error ({request_type}): {e.__class__.__name__} ({str(e)})')
-        response_json = response.json()
-        if response.status_code != 200:
-            raise ServiceError(f'LifePay service не доступен {response.status_code}')
-        elif response_json['code'] != 0:
-            raise ServiceError(f'LifePay service  {response_json["code"]}:{response_json["message"]}.\nDetails:'
-                               f'{json.dumps(response_json["data"], ensure_ascii=False, indent=2)}')
+        operation = urlsplit(url).path.rstrip('/').rsplit('/', 1)[-1]
+        with outbound_call('lifepay', operation) as call:
+            try:
+                payload = payload | self.__auth_credentials if payload else self.__auth_credentials
+                Logger_lifePay.info(json.dumps(payload))
+                if request_type == 'POST':
+                    response = self.__transport(url).request('POST', url, json=payload)
+                elif request_type == 'GET':
+                    response = self.__transport(url).request('GET', url, params=payload)
+                else:
+                    raise NotImplementedError(f'Метод {request_type} не поддерживается '
+                                              f'(Возможные варианты GET, POST)')
+
+            except Exception as e:
+                call['status'] = e.__class__.__name__
+                raise ServiceError(f'Connection error ({request_type}): {e.__class__.__name__} ({str(e)})')
+            call['status'] = response.status_code
+            response_json = response.json()
+            if response.status_code != 200:
+                raise ServiceError(f'LifePay service не доступен {response.status_code}')
+            elif response_json['code'] != 0:
+                call['status'] = f'code_{response_json["code"]}'
+                raise ServiceError(f'LifePay service  {response_json["code"]}:{response_json["message"]}.\nDetails:'
+                                   f'{json.dumps(response_json["data"], ensure_ascii=False, indent=2)}')
         return response_json
 
     def create_recipient(self, payload: dict) -> str:
@@ -136,6 +186,80 @@ class Service(ServiceFactory):
         data = self.__send_request(payload, url, 'GET')
         return data
 
+    def iter_transactions(self,
+                          date_from: date,
+                          date_to: date = None,
+                          page_size: int = TRANSACTIONS_PAGE_LIMIT,
+                          operator: str = None) -> Iterator[LifePayTransaction]:
+        """
+        Постраничный обход чеков (операций) за период. Следующая страница запрашивается параллельно
+        с обработкой текущей, в памяти находится не более двух страниц
+
+        :param date_from: первый день периода (UTC+0)
+        :param date_to: последний день периода (по умолчанию равен date_from)
+        :param page_size: размер страницы (не более 100)
+        :param operator: логин оператора
+        :raise: ServiceError
+        :return: генератор чеков
+        """
+        page_size = min(page_size, TRANSACTIONS_PAGE_LIMIT)
+        days = [date_from + timedelta(days=n) for n in range(((date_to or date_from) - date_from).days + 1)]
+        if not days:
+            return
+
+        def fetch(day: date, offset: int) -> list:
+            payload = {'date': day.isoformat(), 'limit': page_size, 'offset': offset}
+            if operator:
+                payload['operator'] = operator
+            return self.transaction_list(payload).get('data') or []
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            day_index, offset = 0, 0
+            future = executor.submit(fetch, days[day_index], offset)
+            while future is not None:
+                page = future.result()
+                if len(page) == page_size:
+                    offset += page_size
+                else:
+                    # неполная страница - день закончился, переходим к следующему
+                    day_index, offset = day_index + 1, 0
+                future = executor.submit(fetch, days[day_index], offset) if day_index < len(days) else None
+                for item in page:
+                    yield LifePayTransaction.from_dict(item)
+
+    def stage_transactions(self, date_from: date, date_to: date = None) -> int:
+        """
+        Загрузка чеков за период в промежуточную таблицу log.life_pay_receipts (постранично,
+        повторная загрузка обновляет записи)
+
+        :param date_from: первый день периода (UTC+0)
+        :param date_to: последний день периода (по умолчанию равен date_from)
+        :raise: ServiceError
+        :return: количество загруженных чеков
+        """
+        requireMigrations(DbName.CORE, '0003_life_pay_receipts')
+        loaded = 0
+        # отдельная сессия: постраничная фиксация не затрагивает изменения вызывающего кода
+        ses = makeSession(DbName.CORE)
+        try:
+            rows = ({'merchant': self.merchant.value, 'loaded_date': getData(),
+                     **{field: getattr(receipt, field) for field in receipt._fields if field != 'raw'}}
+                    for receipt in self.iter_transactions(date_from, date_to))
+            while chunk := list(islice(rows, TRANSACTIONS_PAGE_LIMIT)):
+                # один чек может попасть на соседние страницы при смещении списка во время обхода
+                page = list({row['uuid']: row for row in chunk if row['uuid']}.values())
+                if not page:
+                    continue
+                stmt = insert(LifePayReceiptStaging).values(page)
+                ses.execute(stmt.on_conflict_do_update(
+                    index_elements=[LifePayReceiptStaging.uuid],
+                    set_={column: stmt.excluded[column] for column in page[0] if column != 'uuid'}))
+                ses.commit()
+                loaded += len(page)
+        finally:
+            ses.close()
+        return loaded
+
 
 class ReceiptCreator(ABC):
     """
@@ -167,6 +291,42 @@ class ReceiptCreator(ABC):
         """
         pass
 
+    @classmethod
+    def prefetch(cls, ses, creators: list):
+        """
+        Предзагрузка данных из БД сразу для пачки чеков одного типа (по умолчанию не требуется)
+
+        :param ses: сессия sql alchemy
+        :param creators: объекты формирования чеков данного типа
+        """
+        pass
+
+
+class MerchantRateLimiter:
+    """
+    Ограничение частоты запросов к LifePay отдельно для каждого мерчанта
+    """
+
+    def __init__(self, rate: float = None):
+        self.interval = 1 / rate if rate else 0
+        self._next_slot = {}
+        self._lock = Lock()
+
+    def wait(self, merchant):
+        """
+        Ожидание свободного слота для запроса от имени мерчанта
+
+        :param merchant: мерчант
+        """
+        if not self.interval:
+            return
+        with self._lock:
+            now = monotonic()
+            slot = max(now, self._next_slot.get(merchant, now))
+            self._next_slot[merchant] = slot + self.interval
+        if slot > now:
+            sleep(slot - now)
+
 
 class ReceiptContext:
     """
@@ -198,16 +358,80 @@ class ReceiptContext:
         if not self._creator:
             raise ServiceError('Отсутствует объект ReceiptCreator')
 
+        return self._create(self._creator).receipt
+
+    def create_receipts(self,
+                        creators: Iterable[ReceiptCreator],
+                        max_workers: int = None,
+                        merchant_rps: float = None) -> List[ReceiptResult]:
+        """
+        Пакетное создание чеков: данные из БД загружаются одним набором запросов на тип чека,
+        запросы к LifePay выполняются параллельно с ограничением частоты по мерчанту
+
+        :param creators: объекты формирования чеков
+        :param max_workers: количество одновременных запросов к LifePay
+        :param merchant_rps: максимальное количество запросов в секунду на мерчанта
+        :return: результаты в порядке переданных объектов (чек или ошибка)
+        """
+        batch_cfg = configs.get('life_pay_batch') or {}
+        max_workers = max_workers or batch_cfg.get('workers', 4)
+        limiter = MerchantRateLimiter(merchant_rps or batch_cfg.get('merchant_rps'))
+        creators = list(creators)
+
+        # ошибка загрузки данных одного типа чеков отмечает ошибкой только чеки этого типа.
+        # Отдельная сессия: откат после ошибки не затрагивает незафиксированные изменения вызывающего кода
+        prefetch_errors = {}
+        ses = makeSession(DbName.CORE)
+        try:
+            with span('receipt.prefetch', f'{len(creators)} receipts'):
+                self._prefetch(ses, creators, prefetch_errors)
+        finally:
+            ses.close()
+
+        # спаны потоков пула относятся к транзакции вызывающего потока
+        hub = sentry_sdk.Hub.current
+
+        def create(creator: ReceiptCreator) -> ReceiptResult:
+            if id(creator) in prefetch_errors:
+                return ReceiptResult(creator, None, prefetch_errors[id(creator)])
+            with sentry_sdk.Hub(hub):
+                limiter.wait(getattr(creator.srv, 'merchant', None))
+                return self._create(creator)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(create, creators))
+
+    def _prefetch(self, ses, creators: List[ReceiptCreator], errors: dict):
+        """
+        Загрузка данных чеков одним набором запросов на тип чека
+
+        :param ses: сессия sql alchemy
+        :param creators: объекты формирования чеков
+        :param errors: ошибки загрузки по id объекта формирования чека
+        """
+        for creator_type, group in groupby(sorted(creators, key=lambda c: type(c).__name__), key=type):
+            group = list(group)
+            try:
+                creator_type.prefetch(ses, group)
+            except Exception as e:
+                ses.rollback()
+                if self.logger:
+                    self.logger.error(f'Не удалось загрузить данные чеков {creator_type.__name__} ({len(group)}). '
+                                      f'{e.__class__.__name__} ({str(e)})')
+                errors.update((id(creator), e) for creator in group)
+
+    def _create(self, creator: ReceiptCreator) -> ReceiptResult:
         try:
-            receipt = self._creator.create_receipt()
+            with span('receipt.create', type(creator).__name__):
+                receipt = creator.create_receipt()
         except Exception as e:
             if self.logger:
-                self.logger.error(f'{self._creator.error_message}. {e.__class__.__name__} ({str(e)})')
-            return None
+                self.logger.error(f'{creator.error_message}. {e.__class__.__name__} ({str(e)})')
+            return ReceiptResult(creator, None, e)
         if self.log_success and self.logger:
-            self.logger.info(self._creator.success_message)
+            self.logger.info(creator.success_message)
 
-        return receipt
+        return ReceiptResult(creator, receipt, None)
 
 
 class PrepaymentSberReceipt(ReceiptCreator):
@@ -222,6 +446,19 @@ class PrepaymentSberReceipt(ReceiptCreator):
         self.order_id = order_id
         self.amount = amount
         self.refund = refund
+        self.prefetched = None
+
+    @classmethod
+    def prefetch(cls, ses, creators: list):
+        object_ids = {creator.object_id for creator in creators}
+        franchise_ids = dict(ses.query(AmoObjects.objects_id, AmoObjects.franchise_id).
+                             filter(AmoObjects.objects_id.in_(object_ids)))
+        franchises = franchise_directory.get_many(franchise_ids.values(), ses)
+        # запрос данных клиента хранится в DB.rawRequest и выполняется для каждого объекта пакета один раз
+        clients = {object_id: ses.execute(rawRequest.CLIENT_INFO_BY_OBJECT_ID, {'object_id': object_id}).first()
+                   for object_id in object_ids}
+        for creator in creators:
+            creator.prefetched = (franchises.get(franchise_ids.get(creator.object_id)), clients.get(creator.object_id))
 
     @property
     def error_message(self):
@@ -232,13 +469,18 @@ class PrepaymentSberReceipt(ReceiptCreator):
         return f"Чек по заказу {self.order_id} успешно сформирован"
 
     def create_receipt(self) -> str:
-        with Session(DbName.CORE) as ses:
-            franchise_id = ses.query(AmoObjects.franchise_id). \
-                filter_by(objects_id=self.object_id). \
-                scalar()
-            franchise = franchise_data(ses, franchise_id)
-            client_info = ses.execute(CLIENT_INFO_BY_OBJECT_ID, {'object_id': self.object_id}).first()
-            phone = ''.join([s for s in client_info.phone if s.isnumeric()])
+        if self.prefetched:
+            franchise, client_info = self.prefetched
+        else:
+            with Session(DbName.CORE) as ses:
+                franchise_id = ses.query(AmoObjects.franchise_id). \
+                    filter_by(objects_id=self.object_id). \
+                    scalar()
+                franchise = franchise_directory.get(franchise_id, ses)
+                client_info = ses.execute(rawRequest.CLIENT_INFO_BY_OBJECT_ID, {'object_id': self.object_id}).first()
+        if client_info is None:
+            raise ServiceError(f'Не найден клиент объекта {self.object_id}')
+        phone = ''.join([s for s in client_info.phone if s.isnumeric()])
 
         bundle = Bundle(
             {
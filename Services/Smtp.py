@@ -1,6 +1,11 @@
 import os
 import smtplib
 import ssl
+from functools import lru_cache
+from threading import Lock
+from time import monotonic
+from typing import Optional
+
 import certifi
 
 from jinja2 import FileSystemLoader
@@ -10,46 +15,149 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
 from Config import configs
+from Metrics import outbound_call
 from .common import ServiceError
 
+TEMPLATES_DIRECTORY = os.path.join(os.path.dirname(__file__), r'templates')
+
+
+@lru_cache(maxsize=None)
+def _templates() -> Environment:
+    # шаблоны компилируются один раз на процесс, изменения файлов подхватываются после перезапуска
+    return Environment(loader=FileSystemLoader(TEMPLATES_DIRECTORY), auto_reload=False)
+
+
+class SmtpSender:
+    """
+    Отправитель писем через одно авторизованное SMTP соединение, которое переиспользуется между письмами.
+    Простаивающее соединение проверяется перед отправкой, при разрыве выполняется переподключение
+    """
+
+    def __init__(self, config: dict):
+        self.host = config.get('HOST')
+        self.port = config.get('PORT')
+        self.from_addr = config.get('FROM')
+        self.username = config.get('username')
+        self.password = config.get('password')
+        self.timeout = config.get('timeout', 30)
+        self.idle_timeout = config.get('idle_timeout', 60)
+        self._context = ssl.create_default_context(cafile=certifi.where())
+        self._server: Optional[smtplib.SMTP_SSL] = None
+        self._used_at = 0
+        self._lock = Lock()
+
+    def _connect(self) -> smtplib.SMTP_SSL:
+        server = smtplib.SMTP_SSL(self.host, self.port, context=self._context, timeout=self.timeout)
+        responseCode, _ = server.ehlo(self.host)
+        if responseCode != 250:
+            server.close()
+            raise ServiceError(f'SMTP сервер отклонил приветствие: {responseCode}')
+        server.login(self.username, self.password)
+        return server
+
+    def _get_server(self) -> smtplib.SMTP_SSL:
+        if self._server and monotonic() - self._used_at > self.idle_timeout:
+            # сервер мог закрыть простаивающее соединение
+            try:
+                if self._server.noop()[0] != 250:
+                    self.close()
+            except (smtplib.SMTPException, OSError):
+                self.close()
+        if not self._server:
+            self._server = self._connect()
+        return self._server
+
+    def _send(self, message: MIMEMultipart):
+        for attempt in range(2):
+            server = self._get_server()
+            try:
+                server.sendmail(self.from_addr, message['To'], message.as_string())
+                self._used_at = monotonic()
+                return
+            except (smtplib.SMTPServerDisconnected, OSError) as e:
+                reconnect = e
+            except smtplib.SMTPResponseException as e:
+                # 421 - сервер закрывает соединение
+                if e.smtp_code != 421:
+                    raise
+                reconnect = e
+            self.close()
+            if attempt:
+                raise reconnect
+
+    def send(self, message: MIMEMultipart):
+        """
+        Отправка письма
+
+        :param message: письмо
+        :raise: исключения smtplib, ServiceError
+        """
+        with self._lock, outbound_call('smtp', 'send'):
+            self._send(message)
+
+    def close(self):
+        if self._server:
+            try:
+                self._server.quit()
+            except (smtplib.SMTPException, OSError):
+                self._server.close()
+        self._server = None
+
+
+_senders = {}
+_senders_pid = None
+_senders_lock = Lock()
+
+
+def get_sender(config_name: str = 'smtp_client') -> SmtpSender:
+    """
+    Общий на процесс отправитель писем для секции настроек
+
+    :param config_name: секция настроек SMTP
+    :return: отправитель писем
+    """
+    global _senders_pid
+
+    with _senders_lock:
+        if _senders_pid != os.getpid():
+            # соединения родительского процесса не используем после fork
+            _senders.clear()
+            _senders_pid = os.getpid()
+        sender = _senders.get(config_name)
+        if sender is None:
+            sender = _senders[config_name] = SmtpSender(configs.get(config_name))
+    return sender
+
 
 class Service:
-    def __init__(self):
-        self.__templatesDirectory = os.path.join(os.path.dirname(__file__), r'templates')
+    def __init__(self, sender: SmtpSender = None):
+        self.sender = sender or get_sender()
 
     def send_payment(self, data: dict, to: str):
+        """
+        Отправка письма со ссылкой на оплату. Ошибки формирования письма (шаблон, данные) не оборачиваются:
+        повтор отправки их не исправит
+
+        :param data: данные шаблона письма
+        :param to: адрес получателя
+        :raise: ServiceError при ошибке SMTP или сети
+        """
+        message = self.__createMessage("payment.html", data, to)
         try:
-            self.__sendEmail("payment.html", data, to)
-        except Exception as e:
+            self.sender.send(message)
+        except (smtplib.SMTPException, OSError) as e:
             raise ServiceError(f'Не удалось отправить письмо: {e.__class__.__name__}({str(e)}')
 
-    def __sendEmail(self, template, data: dict, toEmail: str) -> int:
-        HOST = configs.get('smtp_client').get('HOST')
-        PORT = configs.get('smtp_client').get('PORT')
-        FROM = configs.get('smtp_client').get('FROM')
-        username = configs.get('smtp_client').get('username')
-        password = configs.get('smtp_client').get('password')
-
+    def __createMessage(self, template, data: dict, toEmail: str) -> MIMEMultipart:
         emailContent = self.__renderTemplate(template, data=data)
 
         message = MIMEMultipart("Alternative")
         message["Subject"] = "Payments"
-        message["From"] = FROM
+        message["From"] = self.sender.from_addr
         message["To"] = toEmail
         message.attach(MIMEText(emailContent, "html"))
+        return message
 
-        context = ssl.create_default_context(cafile=certifi.where())
-        with smtplib.SMTP_SSL(HOST, PORT, context=context) as server:
-            # server.set_debuglevel(1)
-            responseCode, _ = server.ehlo(HOST)
-            if responseCode == 250:
-                server.login(username, password)
-                server.sendmail(FROM, toEmail, message.as_string())
-                return 0
-        return -1
-
-    def __renderTemplate(self, template: str, data: dict = None):
-        env = Environment()
-        env.loader = FileSystemLoader(self.__templatesDirectory)
-        _template = env.get_template(template)
-        return _template.render(data=data)
+    @staticmethod
+    def __renderTemplate(template: str, data: dict = None):
+        return _templates().get_template(template).render(data=data)
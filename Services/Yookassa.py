@@ -1,25 +1,103 @@
 from collections import namedtuple
+from threading import Lock
 from traceback import format_exc
-from typing import TypeVar, Optional
+from typing import TypeVar, Optional, Type
 
 from flask import request
 from yookassa.domain.common import SecurityHelper
 from yookassa.domain.notification import WebhookNotificationFactory
 from yookassa.domain.response import PaymentResponse
 
+from Metrics import outbound_call
 from Services.common import ServiceFactory, Merchant, ServiceError, uuid
+from Services.transport import get_transport
 from yookassa import Configuration, Payment
-from yookassa.domain.common.user_agent import Version
+from yookassa.client import ApiClient
+from yookassa.domain.common.user_agent import Version, UserAgent
 from Config import configs
 
 
 SelfService = TypeVar('SelfService', bound="Service")
 
 
-Webhook = namedtuple("Webhook", ("transaction_id", "event", "merchant"))
+Webhook = namedtuple("Webhook", ("transaction_id", "event", "merchant", "payment_id"))
 Order = namedtuple("Order", ("order_id", "order_url"))
 
 
+class MerchantApiClient(ApiClient):
+    """
+    Клиент API юкассы с собственными учётными данными мерчанта (без глобального Configuration.configure)
+    и общим на процесс пулом соединений
+    """
+    endpoint = Configuration.api_endpoint()
+
+    def __init__(self, shop_id, secret_key: str):
+        # базовый конструктор не вызывается: он читает глобальную конфигурацию SDK
+        self.configuration = None
+        self.shop_id = shop_id
+        self.shop_password = secret_key
+        self.auth_token = None
+        self.timeout = Configuration.timeout
+        self.max_attempts = Configuration.max_attempts
+        self.user_agent = UserAgent()
+        self.user_agent.framework = Version('Flask', '2.1.2')
+
+    def transport_config(self) -> dict:
+        """
+        Параметры HTTP клиента мерчанта. Как и в ApiClient.get_session SDK, POST повторяется при ответе 202
+        (операция ещё обрабатывается): повтор безопасен, так как запрос отправляется с тем же Idempotence-Key
+
+        :return: параметры для get_transport
+        """
+        return {**(configs.get('yookassa_http') or {}),
+                'retries': self.max_attempts,
+                'backoff_factor': self.timeout / 1000,
+                'retry_methods': ('POST',),
+                'retry_statuses': (202,)}
+
+    def execute(self, body, method, path, query_params, request_headers):
+        transport = get_transport(('yookassa', self.shop_id), config=self.transport_config())
+        self.log_request(body, method, path, query_params, request_headers)
+        raw_response = transport.request(method,
+                                         self.endpoint + path,
+                                         params=query_params,
+                                         headers=request_headers,
+                                         json=body,
+                                         verify=Configuration.verify)
+        # get_response_info SDK вызывает raise_for_status, для журнала достаточно кода ответа
+        self.log_response(raw_response.content, {'status_code': raw_response.status_code}, raw_response.headers)
+        return raw_response
+
+
+_merchant_payments = {}
+_merchant_payments_lock = Lock()
+
+
+def merchant_payment_api(merchant: str) -> Type[Payment]:
+    """
+    API платежей юкассы, привязанное к мерчанту. Создаётся один раз на процесс
+
+    :param merchant: имя мерчанта в конфигурационном файле
+    :raise: ServiceError
+    :return: класс с методами Payment.create/find_one/cancel от имени мерчанта
+    """
+    with _merchant_payments_lock:
+        payment_api = _merchant_payments.get(merchant)
+        if payment_api is None:
+            try:
+                merchant_cfg = configs['yookassa']['merchants'][merchant]
+                client = MerchantApiClient(merchant_cfg['shop_id'], merchant_cfg['secret_key'])
+            except KeyError:
+                raise ServiceError(f'Merchant {merchant} not found in config file')
+
+            class MerchantPayment(Payment):
+                def __init__(self):
+                    self.client = client
+
+            payment_api = _merchant_payments[merchant] = MerchantPayment
+    return payment_api
+
+
 class Service(ServiceFactory):
     """
     Класс, реализующий паттерн фасад для работы с API юкассы
@@ -27,11 +105,7 @@ class Service(ServiceFactory):
 
     def __init__(self, merchant: Merchant = Merchant.DOMEO_MART):
         self.merchant = merchant.value
-        try:
-            merchant = configs['yookassa']['merchants'][self.merchant]
-            Configuration.configure(merchant['shop_id'], merchant['secret_key'], framework=Version('Flask', '2.1.2'))
-        except KeyError:
-            raise ServiceError(f'Merchant {merchant.value} not found in config file')
+        self.payments = merchant_payment_api(self.merchant)
 
     @classmethod
     def create_from_user_id(cls, user_id: int, *args, **kwargs) -> Optional[SelfService]:
@@ -74,14 +148,14 @@ class Service(ServiceFactory):
         }
 
         try:
-            payment = Payment.create(data, idempotency_key=uuid())
+            with outbound_call('yookassa', 'create'):
+                payment = self.payments.create(data, idempotency_key=uuid())
         except Exception as err:
             raise ServiceError(f"Ошибка создания заказа: {str(err)}\n{format_exc()}")
 
         return Order(payment["id"], payment['confirmation']['confirmation_url'])
 
-    @staticmethod
-    def decline_order(order_id: str):
+    def decline_order(self, order_id: str):
         """
         Отклонение заказа
 
@@ -89,12 +163,12 @@ class Service(ServiceFactory):
         :return:
         """
         try:
-            _ = Payment.cancel(order_id)
+            with outbound_call('yookassa', 'cancel'):
+                _ = self.payments.cancel(order_id)
         except Exception as err:
             raise ServiceError(f"Ошибка отмены заказа: {str(err)}\n{format_exc()}")
 
-    @staticmethod
-    def get_order(order_id: str) -> dict:
+    def get_order(self, order_id: str) -> dict:
         """
         Получение данных по заказу
 
@@ -102,7 +176,8 @@ class Service(ServiceFactory):
         :return: объект заказа
         """
         try:
-            payment = Payment.find_one(order_id)
+            with outbound_call('yookassa', 'find_one'):
+                payment = self.payments.find_one(order_id)
         except Exception as err:
             raise ServiceError(f"Ошибка получения заказа: {str(err)}\n{format_exc()}")
 
@@ -146,4 +221,5 @@ class Service(ServiceFactory):
 
         return Webhook(transaction_id=response_object.metadata["transaction_id"],
                        merchant=Merchant.find_merchant(response_object.metadata["merchant"]),
-                       event=notification_object.event)
+                       event=notification_object.event,
+                       payment_id=response_object.id)
@@ -0,0 +1,225 @@
+import hashlib
+import json
+from itertools import islice
+from time import perf_counter
+from typing import Iterable
+
+from sqlalchemy import text
+
+from Config import configs
+from DB import Session, DbName
+from DB.connections import makeSession
+from DB.migrations import requireMigrations
+from DB.models import Batch, getData
+from Logger import get_logger
+from .common import ServiceError
+from .orders_import import copy_rows
+
+Logger = get_logger('catalog_sync', 'catalog_sync')
+
+BUSINESS_ENTITY = 'product.shop_prorabam'
+
+PRODUCT_COLUMNS = ('src_product_code', 'article', 'section_name', 'name', 'unit', 'description', 'vendor_code')
+# ограничения длины столбцов product.shop_prorabam
+COLUMN_LIMITS = {'src_product_code': 256, 'section_name': 256, 'name': 512, 'unit': 128, 'description': 1024,
+                 'vendor_code': 64}
+
+STAGING_DDL = '''
+CREATE TEMP TABLE products_stage (
+    seq bigint, record_hash varchar(32), src_product_code varchar(256), article varchar, section_name varchar(256),
+    name varchar(512), unit varchar(128), description varchar(1024), vendor_code varchar(64)
+) ON COMMIT DROP;
+'''
+
+# последняя версия товара в выгрузке и её сравнение с каталогом по хэшу
+DIFF_SQL = '''
+CREATE TEMP TABLE products_latest ON COMMIT DROP AS
+SELECT DISTINCT ON (src_product_code) * FROM products_stage ORDER BY src_product_code, seq DESC;
+CREATE INDEX ON products_latest (src_product_code);
+ANALYZE products_latest;
+
+CREATE TEMP TABLE products_diff ON COMMIT DROP AS
+SELECT 'insert'::text AS change, s.src_product_code
+  FROM products_latest s
+ WHERE NOT EXISTS (SELECT 1 FROM product.shop_prorabam p WHERE p.src_product_code = s.src_product_code)
+UNION ALL
+SELECT 'update', s.src_product_code
+  FROM products_latest s
+  JOIN product.shop_prorabam p ON p.src_product_code = s.src_product_code
+ WHERE p.record_hash IS DISTINCT FROM s.record_hash;
+'''
+
+DELETED_SQL = '''
+INSERT INTO products_diff
+SELECT 'delete', p.src_product_code
+  FROM product.shop_prorabam p
+ WHERE p.src_product_code IS NOT NULL
+   AND NOT EXISTS (SELECT 1 FROM products_latest s WHERE s.src_product_code = p.src_product_code);
+'''
+
+APPLY_SQL = f'''
+UPDATE product.shop_prorabam p
+   SET batch_id = :batch_id, record_hash = s.record_hash,
+       {', '.join(f'{c} = s.{c}' for c in PRODUCT_COLUMNS if c != 'src_product_code')}
+  FROM products_latest s
+  JOIN products_diff d ON d.src_product_code = s.src_product_code AND d.change = 'update'
+ WHERE p.src_product_code = s.src_product_code;
+
+INSERT INTO product.shop_prorabam (batch_id, record_hash, {', '.join(PRODUCT_COLUMNS)})
+SELECT :batch_id, s.record_hash, {', '.join(f's.{c}' for c in PRODUCT_COLUMNS)}
+  FROM products_latest s
+  JOIN products_diff d ON d.src_product_code = s.src_product_code AND d.change = 'insert';
+
+DELETE FROM product.shop_prorabam p
+ USING products_diff d
+ WHERE d.change = 'delete' AND p.src_product_code = d.src_product_code;
+'''
+
+
+def normalize_product(raw: dict) -> tuple:
+    """
+    Приведение товара из выгрузки 1С к столбцам каталога
+
+    :param raw: товар из выгрузки
+    :raise: ValueError
+    :return: хэш записи и значения столбцов (в порядке PRODUCT_COLUMNS)
+    """
+    values = []
+    for column in PRODUCT_COLUMNS:
+        value = raw.get(column)
+        value = None if value in (None, '') else str(value).strip()
+        if value and column in COLUMN_LIMITS and len(value) > COLUMN_LIMITS[column]:
+            raise ValueError(f'Товар {raw.get("src_product_code")}: длина {column} больше {COLUMN_LIMITS[column]}')
+        values.append(value)
+    if not values[0]:
+        raise ValueError(f'Товар без кода 1С: {json.dumps(raw, ensure_ascii=False)[:200]}')
+    record_hash = hashlib.md5(json.dumps(values, ensure_ascii=False).encode('utf-8')).hexdigest()
+    return record_hash, values
+
+
+class CatalogSync:
+    """
+    Инкрементальная синхронизация каталога товаров 1С (product.shop_prorabam). Записи выгрузки сравниваются
+    с каталогом по хэшу полей, в каталог пишутся только добавленные, изменённые и (для полной выгрузки)
+    удалённые товары
+    """
+
+    def __init__(self, chunk_size: int = None, sample_size: int = 20):
+        """
+        :param chunk_size: количество товаров, загружаемых в промежуточную таблицу за один COPY
+        :param sample_size: количество кодов товаров каждого вида изменений в отчёте
+        """
+        cfg = configs.get('catalog_sync') or {}
+        self.chunk_size = chunk_size or cfg.get('chunk_size', 10000)
+        self.max_delete_ratio = cfg.get('max_delete_ratio', 0.2)
+        self.sample_size = sample_size
+
+    def run(self,
+            products: Iterable[dict],
+            full: bool = True,
+            dry_run: bool = False,
+            db_name: DbName = DbName.CORE) -> dict:
+        """
+        Синхронизация каталога одной транзакцией
+
+        :param products: товары выгрузки (итератор, читается частями по chunk_size)
+        :param full: выгрузка содержит весь каталог (отсутствующие в ней товары удаляются)
+        :param dry_run: только отчёт об изменениях, каталог не изменяется
+        :param db_name: база данных
+        :return: отчёт: количество товаров выгрузки, ошибок, добавленных, изменённых и удалённых товаров,
+            примеры кодов товаров по видам изменений и время этапов
+        """
+        # log.batch.stats, product.shop_prorabam.record_hash и индекс по коду 1С
+        requireMigrations(db_name, '0001_batch_stats', '0002_catalog_record_hash')
+        report = {'read': 0, 'rejected': 0, 'dry_run': dry_run}
+        started = perf_counter()
+        # dry run выполняется в отдельной сессии: откат не затрагивает изменения вызывающего кода в общей
+        with (makeSession(db_name) if dry_run else Session(db_name)) as ses:
+            self._stage(ses, products, report)
+            report['staged_sec'] = round(perf_counter() - started, 3)
+
+            self._diff(ses, full, dry_run, report)
+            report['diff_sec'] = round(perf_counter() - started, 3)
+
+            if dry_run:
+                ses.rollback()
+            else:
+                self._apply(ses, report, started)
+
+        Logger.info(f'Синхронизация каталога{" (dry run)" if dry_run else ""}: прочитано {report["read"]}, '
+                    f'отклонено {report["rejected"]}, добавлено {report["insert"]}, изменено {report["update"]}, '
+                    f'удалено {report["delete"]}')
+        return report
+
+    def _stage(self, ses, products: Iterable[dict], report: dict):
+        """
+        Проверка товаров выгрузки и загрузка частями по chunk_size в промежуточную таблицу (COPY)
+
+        :param ses: сессия sql alchemy
+        :param products: товары выгрузки
+        :param report: отчёт (количество прочитанных и отклонённых товаров)
+        """
+        ses.execute(text(STAGING_DDL))
+        cursor = ses.connection().connection.cursor()
+        products, seq = iter(products), 0
+        while chunk := list(islice(products, self.chunk_size)):
+            rows = []
+            for raw in chunk:
+                seq += 1
+                try:
+                    record_hash, values = normalize_product(raw)
+                except ValueError as e:
+                    report['rejected'] += 1
+                    if report['rejected'] <= 100:
+                        Logger.error(str(e))
+                    continue
+                rows.append((seq, record_hash, *values))
+            copy_rows(cursor, 'products_stage', ('seq', 'record_hash', *PRODUCT_COLUMNS), rows)
+            report['read'] += len(chunk)
+
+    def _diff(self, ses, full: bool, dry_run: bool, report: dict):
+        """
+        Сравнение выгрузки с каталогом: количество и примеры кодов добавленных, изменённых и удалённых товаров
+
+        :param ses: сессия sql alchemy
+        :param full: выгрузка содержит весь каталог
+        :param dry_run: только отчёт об изменениях
+        :param report: отчёт
+        :raise: ServiceError, если удаляется больше max_delete_ratio каталога
+        """
+        ses.execute(text(DIFF_SQL))
+        # выгрузка без принятых товаров (пустая или полностью отклонённая) не означает пустой каталог
+        if full and report['read'] - report['rejected'] > 0:
+            ses.execute(text(DELETED_SQL))
+        for change, count in ses.execute(text('SELECT change, count(*) FROM products_diff GROUP BY change')):
+            report[change] = count
+        if report.get('delete') and not dry_run:
+            catalog_size = ses.execute(text('SELECT count(*) FROM product.shop_prorabam')).scalar()
+            if report['delete'] > catalog_size * self.max_delete_ratio:
+                raise ServiceError(f'Синхронизация каталога удаляет {report["delete"]} из {catalog_size} товаров '
+                                   f'(допустимо {self.max_delete_ratio:.0%}), проверьте выгрузку')
+        for change in ('insert', 'update', 'delete'):
+            report.setdefault(change, 0)
+            report[f'{change}_sample'] = ses.execute(
+                text('SELECT src_product_code FROM products_diff WHERE change = :change '
+                     'ORDER BY src_product_code LIMIT :limit'),
+                {'change': change, 'limit': self.sample_size}).scalars().all()
+
+    @staticmethod
+    def _apply(ses, report: dict, started: float):
+        """
+        Запись изменений в каталог и фиксация запуска строкой log.batch
+
+        :param ses: сессия sql alchemy
+        :param report: отчёт
+        :param started: время начала синхронизации (perf_counter)
+        """
+        batch = Batch(business_entity=BUSINESS_ENTITY, date_start=getData())
+        ses.add(batch)
+        ses.flush()
+        report['batch_id'] = batch.batch_id
+        ses.execute(text(APPLY_SQL), {'batch_id': batch.batch_id})
+        report['total_sec'] = round(perf_counter() - started, 3)
+        batch.date_end = getData()
+        batch.stats = {k: v for k, v in report.items() if not k.endswith('_sample')}
+        ses.commit()
@@ -0,0 +1,334 @@
+import json
+from collections import namedtuple, OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Optional, Iterable, Dict
+
+from redis import Redis
+from sqlalchemy import event, and_
+from sqlalchemy.orm import Session as OrmSession, object_session
+
+from Config import configs
+from DB import Session, DbName
+from DB.models import Franchise, AmoObjects, EstimateObjects, ObjectBudget, Report
+from Logger import get_logger
+from Metrics import CACHE_REQUESTS
+
+FranchiseRequisites = namedtuple('FranchiseRequisites',
+                                 ('franchise_id', 'inn', 'kpp', 'name', 'phone', 'bank_code', 'account'))
+
+
+class FranchiseDirectory:
+    """
+    Кэш платёжных реквизитов франчайзи (read-through с TTL).
+    Хранит компактные неизменяемые записи вместо ORM объектов со всеми связями
+    """
+
+    def __init__(self, ttl: float = 300):
+        self.ttl = ttl
+        self._items = {}
+        self._lock = Lock()
+
+    def get(self, franchise_id: int, ses=None) -> Optional[FranchiseRequisites]:
+        """
+        Реквизиты франчайзи
+
+        :param franchise_id: идентификатор франчайзи
+        :param ses: сессия sql alchemy (если не указана, открывается новая)
+        :return: реквизиты или None, если франчайзи не найден
+        """
+        if franchise_id is None:
+            return None
+        return self.get_many((franchise_id,), ses).get(franchise_id)
+
+    def get_many(self, franchise_ids: Iterable[int], ses=None) -> Dict[int, FranchiseRequisites]:
+        """
+        Реквизиты нескольких франчайзи, отсутствующие в кэше загружаются одним запросом
+
+        :param franchise_ids: идентификаторы франчайзи
+        :param ses: сессия sql alchemy (если не указана, открывается новая)
+        :return: словарь реквизитов по идентификатору франчайзи
+        """
+        now = monotonic()
+        found, missing = {}, set()
+        with self._lock:
+            for franchise_id in set(franchise_ids) - {None}:
+                cached = self._items.get(franchise_id)
+                if cached and cached[0] > now:
+                    found[franchise_id] = cached[1]
+                else:
+                    missing.add(franchise_id)
+
+        if missing:
+            if ses is None:
+                with Session(DbName.CORE) as ses:
+                    loaded = self._load(ses, missing)
+            else:
+                loaded = self._load(ses, missing)
+            with self._lock:
+                for record in loaded:
+                    self._items[record.franchise_id] = (now + self.ttl, record)
+            found.update((record.franchise_id, record) for record in loaded)
+
+        return found
+
+    def invalidate(self, franchise_id: int = None):
+        """
+        Сброс кэша по франчайзи или целиком
+
+        :param franchise_id: идентификатор франчайзи (если не указан, кэш очищается полностью)
+        """
+        with self._lock:
+            if franchise_id is None:
+                self._items.clear()
+            else:
+                self._items.pop(franchise_id, None)
+
+    @staticmethod
+    def _load(ses, franchise_ids: set) -> list:
+        rows = ses.query(Franchise.franchise_id,
+                         Franchise.inn,
+                         Franchise.kpp,
+                         Franchise.name,
+                         Franchise.phone,
+                         Franchise.bank_code,
+                         Franchise.account). \
+            filter(Franchise.franchise_id.in_(franchise_ids))
+        return [FranchiseRequisites(*row) for row in rows]
+
+
+franchise_directory = FranchiseDirectory(ttl=(configs.get('franchise_directory') or {}).get('ttl', 300))
+
+
+# сбросы кэшей, отложенные до фиксации транзакции сессии: пары (функция сброса, ключ)
+PENDING_INVALIDATIONS = 'pending_cache_invalidations'
+
+
+def invalidate_on_commit(target, invalidate, key):
+    """
+    Сброс записи кэша после фиксации транзакции, в которой изменена строка. События маппера срабатывают
+    при flush: сброс до фиксации позволил бы параллельному чтению снова закэшировать старую строку,
+    а при откате сбросил бы запись зря
+
+    :param target: изменённый объект модели
+    :param invalidate: функция сброса записи кэша
+    :param key: ключ записи
+    """
+    ses = object_session(target)
+    if ses is None:
+        invalidate(key)
+        return
+    ses.info.setdefault(PENDING_INVALIDATIONS, set()).add((invalidate, key))
+
+
+@event.listens_for(OrmSession, 'after_commit')
+def invalidate_committed(ses):
+    for invalidate, key in ses.info.pop(PENDING_INVALIDATIONS, ()):
+        invalidate(key)
+
+
+@event.listens_for(OrmSession, 'after_soft_rollback')
+def forget_rolled_back(ses, previous_transaction):
+    # откат точки сохранения не отменяет изменений внешней транзакции
+    if previous_transaction.parent is None:
+        ses.info.pop(PENDING_INVALIDATIONS, None)
+
+
+@event.listens_for(Franchise, 'after_insert')
+@event.listens_for(Franchise, 'after_update')
+@event.listens_for(Franchise, 'after_delete')
+def invalidate_franchise(_mapper, _connection, target):
+    # изменения через ORM в этом процессе сбрасывают запись после фиксации, в остальных - по истечении TTL
+    invalidate_on_commit(target, franchise_directory.invalidate, target.franchise_id)
+
+
+class ObjectMerchant(namedtuple('ObjectMerchant', ('object_id', 'franchise_id', 'is_nominal'))):
+    """
+    Мерчант объекта: для номинального объекта платежи проводятся без мерчанта франчайзи
+    """
+
+    @property
+    def merchant_id(self) -> Optional[int]:
+        return None if self.is_nominal else self.franchise_id
+
+
+class LRUCache:
+    """
+    Ограниченный по размеру кэш с вытеснением давно не используемых записей и TTL
+    """
+
+    def __init__(self, max_size: int = 4096, ttl: float = 600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            cached = self._items.get(key)
+            if not cached:
+                return None
+            if cached[0] <= monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return cached[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = (monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class MerchantResolver:
+    """
+    Определение мерчанта по объекту или акту (объект -> франчайзи -> мерчант).
+    Мерчанты объектов кэшируются в общем Redis (сброс при изменении виден всем процессам), без Redis -
+    в LRU процесса с коротким TTL: изменение, сделанное в другом процессе, видно не позже чем через local_ttl
+    """
+    REDIS_PREFIX = 'payments:merchant:object:'
+
+    def __init__(self, max_size: int = 4096, ttl: float = 600, local_ttl: float = 30, redis: Redis = None):
+        """
+        :param max_size: размер LRU процесса
+        :param ttl: время хранения в Redis и привязки акта к объекту в процессе (с)
+        :param local_ttl: время хранения мерчанта объекта в LRU процесса, если Redis не используется (с)
+        :param redis: клиент Redis
+        """
+        self.ttl = ttl
+        self.logger = get_logger('merchant_resolver', 'merchant_resolver')
+        self._objects = None if redis else LRUCache(max_size, local_ttl)
+        # акт не переносится между объектами, привязка хранится в процессе
+        self._certificates = LRUCache(max_size, ttl)
+        self._redis = redis
+
+    def resolve_object(self, ses, object_id: int) -> ObjectMerchant:
+        """
+        Мерчант объекта
+
+        :param ses: сессия sql alchemy
+        :param object_id: идентификатор объекта
+        :return: франчайзи объекта и признак номинального объекта (без объекта - мерчант по умолчанию)
+        """
+        if object_id is None:
+            return ObjectMerchant(None, None, False)
+        object_id = int(object_id)
+        if self._objects is not None:
+            merchant = self._objects.get(object_id)
+            if merchant:
+                CACHE_REQUESTS.labels('merchant_lru', 'hit').inc()
+                return merchant
+            CACHE_REQUESTS.labels('merchant_lru', 'miss').inc()
+
+        merchant = self._redis_get(object_id)
+        if not merchant:
+            merchant = self._load_object(ses, object_id)
+            self._redis_set(merchant)
+        if self._objects is not None:
+            self._objects.set(object_id, merchant)
+        return merchant
+
+    def resolve_certificate(self, ses, certificate_code: str) -> Optional[ObjectMerchant]:
+        """
+        Мерчант объекта, к которому относится акт
+
+        :param ses: сессия sql alchemy
+        :param certificate_code: идентификатор акта
+        :return: франчайзи объекта и признак номинального объекта или None, если акт не найден
+        """
+        object_id = self._certificates.get(certificate_code)
+        if object_id is None:
+            CACHE_REQUESTS.labels('merchant_certificate', 'miss').inc()
+            object_id = ses.query(ObjectBudget.object_id). \
+                join(Report, and_(Report.budgets_id == ObjectBudget.budgets_id,
+                                  Report.certificate_code == certificate_code)). \
+                limit(1).scalar()
+            if object_id is None:
+                return None
+            self._certificates.set(certificate_code, object_id)
+        else:
+            CACHE_REQUESTS.labels('merchant_certificate', 'hit').inc()
+        return self.resolve_object(ses, object_id)
+
+    def invalidate_object(self, object_id: int):
+        """
+        Сброс кэша по объекту (смена франчайзи или признака номинального объекта)
+
+        :param object_id: идентификатор объекта
+        """
+        if self._objects is not None:
+            self._objects.delete(object_id)
+        if self._redis:
+            try:
+                self._redis.delete(f'{self.REDIS_PREFIX}{object_id}')
+            except Exception as e:
+                self.logger.error(f'Не удалось сбросить кэш объекта {object_id} в Redis: {str(e)}')
+
+    @staticmethod
+    def _load_object(ses, object_id: int) -> ObjectMerchant:
+        franchise_id = ses.query(AmoObjects.franchise_id).filter_by(objects_id=object_id).scalar_subquery()
+        is_nominal = ses.query(EstimateObjects.is_nominal).filter_by(object_id=object_id).scalar_subquery()
+        row = ses.query(franchise_id.label('franchise_id'), is_nominal.label('is_nominal')).one()
+        return ObjectMerchant(object_id, row.franchise_id, bool(row.is_nominal))
+
+    def _redis_get(self, object_id: int) -> Optional[ObjectMerchant]:
+        if not self._redis:
+            return None
+        try:
+            cached = self._redis.get(f'{self.REDIS_PREFIX}{object_id}')
+        except Exception as e:
+            self.logger.error(f'Не удалось прочитать кэш объекта {object_id} из Redis: {str(e)}')
+            return None
+        if cached is None:
+            CACHE_REQUESTS.labels('merchant_redis', 'miss').inc()
+            return None
+        CACHE_REQUESTS.labels('merchant_redis', 'hit').inc()
+        return ObjectMerchant(object_id, *json.loads(cached))
+
+    def _redis_set(self, merchant: ObjectMerchant):
+        if not self._redis:
+            return
+        try:
+            self._redis.set(f'{self.REDIS_PREFIX}{merchant.object_id}',
+                            json.dumps([merchant.franchise_id, merchant.is_nominal]),
+                            ex=int(self.ttl))
+        except Exception as e:
+            self.logger.error(f'Не удалось записать кэш объекта {merchant.object_id} в Redis: {str(e)}')
+
+
+def _resolver_redis() -> Optional[Redis]:
+    if not (configs.get('merchant_resolver') or {}).get('redis'):
+        return None
+    rc = configs.get('redis')
+    return Redis(host=rc.get('host'), port=rc.get('port'), db=rc.get('db'), password=rc.get('password'))
+
+
+_resolver_cfg = configs.get('merchant_resolver') or {}
+merchant_resolver = MerchantResolver(max_size=_resolver_cfg.get('max_size', 4096),
+                                     ttl=_resolver_cfg.get('ttl', 600),
+                                     local_ttl=_resolver_cfg.get('local_ttl', 30),
+                                     redis=_resolver_redis())
+
+
+@event.listens_for(AmoObjects, 'after_update')
+@event.listens_for(AmoObjects, 'after_delete')
+def invalidate_object_franchise(_mapper, _connection, target):
+    # смена франчайзи объекта (amocrm_objects.franchise_id); LRU других процессов устаревает по local_ttl
+    invalidate_on_commit(target, merchant_resolver.invalidate_object, target.objects_id)
+
+
+@event.listens_for(EstimateObjects, 'after_update')
+@event.listens_for(EstimateObjects, 'after_delete')
+def invalidate_object_nominal(_mapper, _connection, target):
+    # смена признака номинального объекта (estimate_objects.is_nominal)
+    invalidate_on_commit(target, merchant_resolver.invalidate_object, target.object_id)
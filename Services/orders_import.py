@@ -0,0 +1,231 @@
+import csv
+import io
+from datetime import datetime, date
+from itertools import islice
+from time import perf_counter
+from typing import Iterable, Iterator, Optional
+
+from sqlalchemy import text
+
+from Config import configs
+from DB import Session, DbName
+from DB.connections import makeSession
+from DB.migrations import requireMigrations
+from DB.models import Batch, OrdersRaw, getData
+from Logger import get_logger
+
+Logger = get_logger('orders_import', 'orders_import')
+
+BUSINESS_ENTITY = 'shop_prorabam.orders'
+
+ORDER_COLUMNS = ('order_code', 'amount', 'order_date', 'object_id', 'foreman', 'income_type',
+                 'internal_order_number', 'parent_order')
+ITEM_COLUMNS = ('order_id', 'article', 'amount', 'quantity', 'discount', 'discount_amount', 'unit')
+
+STAGING_DDL = '''
+CREATE TEMP TABLE orders_stage (
+    seq bigint, order_code varchar(32), amount float8, order_date date, object_id integer, foreman varchar(64),
+    income_type varchar(32), internal_order_number varchar, parent_order varchar
+) ON COMMIT DROP;
+CREATE TEMP TABLE orders_items_stage (
+    seq bigint, order_id varchar(32), article integer, amount float8, quantity float8, discount float8,
+    discount_amount float8, unit varchar
+) ON COMMIT DROP;
+'''
+
+# последняя версия заказа в выгрузке заменяет заказ и его корзину
+UPSERT_SQL = f'''
+CREATE TEMP TABLE orders_latest ON COMMIT DROP AS
+SELECT DISTINCT ON (order_code) * FROM orders_stage ORDER BY order_code, seq DESC;
+
+INSERT INTO shop_prorabam.orders (batch_id, {', '.join(ORDER_COLUMNS)})
+SELECT :batch_id, {', '.join(f's.{c}' for c in ORDER_COLUMNS)}
+  FROM orders_latest s
+    ON CONFLICT (order_code) DO UPDATE
+   SET {', '.join(f'{c} = EXCLUDED.{c}' for c in ('batch_id', *ORDER_COLUMNS) if c != 'order_code')};
+
+DELETE FROM shop_prorabam.orders_items i USING orders_latest s WHERE i.order_id = s.order_code;
+
+INSERT INTO shop_prorabam.orders_items (batch_id, {', '.join(ITEM_COLUMNS)})
+SELECT :batch_id, {', '.join(f'i.{c}' for c in ITEM_COLUMNS)}
+  FROM orders_items_stage i
+  JOIN orders_latest s ON s.order_code = i.order_id AND s.seq = i.seq;
+'''
+
+
+class InvalidOrder(ValueError):
+    pass
+
+
+def copy_rows(cursor, table: str, columns: tuple, rows: Iterable[tuple]):
+    """
+    Загрузка строк в таблицу командой COPY (формат csv, None записывается как NULL)
+
+    :param cursor: курсор psycopg2
+    :param table: таблица
+    :param columns: столбцы
+    :param rows: строки
+    """
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cursor.copy_expert(f'COPY {table} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)', buffer)
+
+
+def _float(value) -> Optional[float]:
+    if value in (None, ''):
+        return None
+    return float(str(value).replace(' ', '').replace(',', '.'))
+
+
+def _int(value) -> Optional[int]:
+    if value in (None, ''):
+        return None
+    return int(value)
+
+
+def _date(value) -> Optional[date]:
+    if value in (None, ''):
+        return None
+    for fmt in ('%Y-%m-%d', '%d.%m.%Y', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.strptime(str(value)[:19], fmt).date()
+        except ValueError:
+            continue
+    raise InvalidOrder(f'Неверная дата заказа: {value}')
+
+
+def normalize_order(raw: dict) -> tuple:
+    """
+    Проверка и приведение заказа из выгрузки 1С к столбцам заказа и корзины
+
+    :param raw: заказ из выгрузки
+    :raise: InvalidOrder
+    :return: строка заказа и строки товаров (в порядке ORDER_COLUMNS и ITEM_COLUMNS)
+    """
+    order_code = str(raw.get('order_code') or '').strip()
+    if not order_code or len(order_code) > 32:
+        raise InvalidOrder(f'Неверный номер заказа: {raw.get("order_code")}')
+    try:
+        order = (order_code,
+                 _float(raw.get('amount')),
+                 _date(raw.get('order_date')),
+                 _int(raw.get('object_id')),
+                 raw.get('foreman'),
+                 raw.get('income_type'),
+                 raw.get('internal_order_number'),
+                 raw.get('parent_order'))
+        items = [(order_code,
+                  _int(item.get('article')),
+                  _float(item.get('amount')),
+                  _float(item.get('quantity')),
+                  _float(item.get('discount')),
+                  _float(item.get('discount_amount')),
+                  item.get('unit'))
+                 for item in raw.get('items') or ()]
+    except (TypeError, ValueError) as e:
+        raise InvalidOrder(f'Заказ {order_code}: {str(e)}')
+    return order, items
+
+
+def iter_raw_orders(ses, batch_id: int, fetch_size: int = 500) -> Iterator[dict]:
+    """
+    Потоковое чтение заказов блока загрузки из shop_prorabam.orders_raw (курсор на стороне сервера)
+
+    :param ses: сессия sql alchemy
+    :param batch_id: идентификатор блока загрузки сырых данных
+    :param fetch_size: количество строк, получаемых за одно обращение к серверу
+    :return: генератор заказов
+    """
+    rows = ses.query(OrdersRaw.json). \
+        filter(OrdersRaw.batch_id == batch_id). \
+        order_by(OrdersRaw.id). \
+        execution_options(stream_results=True). \
+        yield_per(fetch_size)
+    for (payload,) in rows:
+        # строка содержит заказ или массив заказов
+        if isinstance(payload, list):
+            yield from payload
+        elif payload:
+            yield payload
+
+
+class OrdersImport:
+    """
+    Загрузка заказов 1С: проверка и приведение частями, COPY в промежуточные таблицы и перенос
+    в shop_prorabam.orders/orders_items запросами над множествами. Запуск фиксируется строкой log.batch
+    """
+
+    def __init__(self, chunk_size: int = None):
+        self.chunk_size = chunk_size or (configs.get('orders_import') or {}).get('chunk_size', 10000)
+
+    def run(self, orders: Iterable[dict], db_name: DbName = DbName.CORE) -> dict:
+        """
+        Загрузка заказов одной транзакцией
+
+        :param orders: заказы выгрузки (итератор, читается частями по chunk_size)
+        :param db_name: база данных
+        :return: статистика запуска (идентификатор блока, количество заказов, товаров, ошибок и время этапов)
+        """
+        # log.batch.stats и уникальный индекс по order_code для ON CONFLICT
+        requireMigrations(db_name, '0001_batch_stats', '0005_orders_order_code_unique')
+        stats = {'read': 0, 'rejected': 0, 'orders': 0, 'items': 0}
+        started = perf_counter()
+        with Session(db_name) as ses:
+            batch = Batch(business_entity=BUSINESS_ENTITY, date_start=getData())
+            ses.add(batch)
+            ses.flush()
+            stats['batch_id'] = batch.batch_id
+
+            ses.execute(text(STAGING_DDL))
+            cursor = ses.connection().connection.cursor()
+            orders, seq = iter(orders), 0
+            while chunk := list(islice(orders, self.chunk_size)):
+                order_rows, item_rows = [], []
+                for raw in chunk:
+                    seq += 1
+                    try:
+                        order, items = normalize_order(raw)
+                    except InvalidOrder as e:
+                        stats['rejected'] += 1
+                        if stats['rejected'] <= 100:
+                            Logger.error(f'Блок {batch.batch_id}: {str(e)}')
+                        continue
+                    order_rows.append((seq, *order))
+                    item_rows.extend((seq, *item) for item in items)
+                copy_rows(cursor, 'orders_stage', ('seq', *ORDER_COLUMNS), order_rows)
+                copy_rows(cursor, 'orders_items_stage', ('seq', *ITEM_COLUMNS), item_rows)
+                stats['read'] += len(chunk)
+            stats['staged_sec'] = round(perf_counter() - started, 3)
+
+            ses.execute(text(UPSERT_SQL), {'batch_id': batch.batch_id})
+            stats['orders'] = ses.execute(text('SELECT count(*) FROM orders_latest')).scalar()
+            stats['items'] = ses.execute(
+                text('SELECT count(*) FROM orders_items_stage i JOIN orders_latest s '
+                     'ON s.order_code = i.order_id AND s.seq = i.seq')).scalar()
+            stats['total_sec'] = round(perf_counter() - started, 3)
+
+            batch.date_end = getData()
+            batch.stats = stats
+            ses.commit()
+
+        Logger.info(f'Блок {stats["batch_id"]}: прочитано {stats["read"]}, отклонено {stats["rejected"]}, '
+                    f'заказов {stats["orders"]}, товаров {stats["items"]}, {stats["total_sec"]} с')
+        return stats
+
+    def run_raw_batch(self, raw_batch_id: int, db_name: DbName = DbName.CORE) -> dict:
+        """
+        Загрузка заказов из сырого блока shop_prorabam.orders_raw
+
+        :param raw_batch_id: идентификатор блока сырых данных
+        :param db_name: база данных
+        :return: статистика запуска
+        """
+        # сырые заказы читаются курсором отдельного соединения: run загружает их в общей сессии
+        ses = makeSession(db_name)
+        try:
+            stats = self.run(iter_raw_orders(ses, raw_batch_id), db_name)
+        finally:
+            ses.close()
+        stats['raw_batch_id'] = raw_batch_id
+        return stats
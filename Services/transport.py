@@ -0,0 +1,142 @@
+import os
+from random import uniform
+from threading import Lock
+from time import monotonic
+
+from requests import Session, Response
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+from urllib3.util.retry import Retry
+
+from .common import ServiceError
+
+
+class CircuitOpenError(ServiceError):
+    default_detail = 'Сервис временно недоступен'
+
+
+class JitterRetry(Retry):
+    """
+    Повтор запросов с экспоненциальной задержкой и случайным разбросом (full jitter)
+    """
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        return uniform(0, backoff) if backoff else 0
+
+
+class CircuitBreaker:
+    """
+    Размыкатель цепи: после серии ошибок запросы к сервису отклоняются сразу, пока не истечёт пауза
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._lock = Lock()
+
+    def before_call(self):
+        """
+        Проверка доступности сервиса перед запросом
+
+        :raise: CircuitOpenError
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if monotonic() - self._opened_at < self.reset_timeout:
+                raise CircuitOpenError(f'{self.name}: сервис недоступен, запросы временно не отправляются')
+            # пауза истекла - пропускаем пробный запрос
+            self._opened_at = None
+            self._failures = self.failure_threshold - 1
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._opened_at = monotonic()
+
+
+class HttpTransport:
+    """
+    HTTP клиент с пулом соединений, таймаутами, повтором идемпотентных запросов и размыкателем цепи.
+    По умолчанию повторяются GET/HEAD/OPTIONS при ответах 502/503/504, набор методов и статусов
+    задаётся параметрами retry_methods и retry_statuses
+    """
+
+    def __init__(self, name: str, headers: dict = None, config: dict = None):
+        config = config or {}
+        self.timeout = (config.get('connect_timeout', 3.05), config.get('read_timeout', 30))
+        self.breaker = CircuitBreaker(name,
+                                      failure_threshold=config.get('failure_threshold', 5),
+                                      reset_timeout=config.get('reset_timeout', 30))
+        retry = JitterRetry(total=config.get('retries', 3),
+                            backoff_factor=config.get('backoff_factor', 0.5),
+                            status_forcelist=frozenset(config.get('retry_statuses', (502, 503, 504))),
+                            allowed_methods=frozenset(config.get('retry_methods', ('GET', 'HEAD', 'OPTIONS'))),
+                            raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=config.get('pool_size', 10),
+                              max_retries=retry)
+        self.session = Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update(headers or {})
+
+    def request(self, method: str, url: str, **kwargs) -> Response:
+        """
+        Отправка запроса
+
+        :param method: HTTP метод
+        :param url: адрес запроса
+        :param kwargs: параметры requests
+        :raise: CircuitOpenError, исключения requests
+        :return: ответ сервиса
+        """
+        self.breaker.before_call()
+        kwargs.setdefault('timeout', self.timeout)
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except (ConnectionError, Timeout):
+            self.breaker.failure()
+            raise
+        if response.status_code >= 500:
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+        return response
+
+
+_transports = {}
+_transports_pid = None
+_transports_lock = Lock()
+
+
+def get_transport(key: tuple, headers: dict = None, config: dict = None) -> HttpTransport:
+    """
+    Общий на процесс HTTP клиент для заданного ключа (например, мерчант и адрес сервиса)
+
+    :param key: ключ клиента
+    :param headers: заголовки по умолчанию
+    :param config: параметры пула, таймаутов, повторов и размыкателя цепи
+    :return: HTTP клиент
+    """
+    global _transports_pid
+
+    with _transports_lock:
+        if _transports_pid != os.getpid():
+            # соединения родительского процесса не используем после fork
+            _transports.clear()
+            _transports_pid = os.getpid()
+        transport = _transports.get(key)
+        if transport is None:
+            transport = _transports[key] = HttpTransport(':'.join(map(str, key)), headers, config)
+    return transport
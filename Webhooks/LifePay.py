@@ -1,4 +1,5 @@
 import json
+from time import perf_counter
 
 from flask import request, Blueprint
 from flask_restful import Resource
@@ -7,6 +8,7 @@ from API.common import resp
 from DB import withSession, DbName
 from DB.models import Transactions
 from Logger import get_logger
+from Metrics import WEBHOOK_DURATION
 
 life_pay_webhooks_bp = Blueprint('life_pay_webhooks_bp', __name__)
 
@@ -20,6 +22,8 @@ class NotificationApi(Resource):
         :param order_id: id транзакции у нас в системе
         :return:
         """
+        started = perf_counter()
+        outcome = 'ignored'
         logger = get_logger('life_pay_webhooks_bp', 'life_pay_webhooks')
         data = request.form.get('data')
         if data:
@@ -28,8 +32,12 @@ class NotificationApi(Resource):
             if ses.query(transaction.exists()).scalar() and data.get('ofd_url'):
                 transaction.update({'receipt': data.get('ofd_url')})
                 ses.commit()
+                outcome = 'receipt_saved'
             if data.get('error_code'):
+                outcome = 'receipt_error'
                 logger.error(f'Чек {data.get("uuid")} не напечатан:\n{json.dumps(data, indent=2, ensure_ascii=False)}')
         else:
+            outcome = 'empty'
             logger.error(f'Не получены от  LifePay  данные по чеку заказа : {order_id}')
+        WEBHOOK_DURATION.labels('lifepay', 'process', outcome).observe(perf_counter() - started)
         return resp({'message': 'ok'}, 200)
@@ -1,14 +1,23 @@
 from datetime import datetime
+from time import perf_counter
 from traceback import format_exc
+from typing import Optional, Tuple
 
-from flask import Blueprint
+import click
+from flask import Blueprint, request
+from sqlalchemy.dialects.postgresql import insert
 from yookassa.domain.notification import WebhookNotificationEventType
 
 from API.common import resp, is_last_certificate_transaction, set_certificate_status, get_franchise_id_by_object_id, \
     MessageService
-from DB import withSession, DbName
-from DB.models import getData, Transactions, CertificateVersion, Report, Franchise, AmoObjects, EntityActivity
+from DB import withSession, DbName, Session
+from DB.loading import query_profile
+from DB.migrations import requireMigrations
+from DB.models import getData, Transactions, CertificateVersion, Report, Franchise, AmoObjects, EntityActivity, \
+    YookassaNotification
 from Logger import get_logger
+from Metrics import WEBHOOK_DURATION
+from MainApp.celery import app as celery_app
 from Services.Yookassa import Service as YookassaService, Webhook
 from Services.LifePay import Service as LifePayService, ReceiptContext, PrepaymentSberReceipt, FranchiseReceipt
 from Services.common import Merchant, PaymentTypes, check_legal, ServiceError, is_nominal_object, FranchiseType, \
@@ -20,21 +29,140 @@ yookassa_webhooks = Blueprint('yookassa_webhooks', 'yookassa_webhooks')
 
 @yookassa_webhooks.route('/yookassa/callback/<string:merchant>', methods=['POST'])
 def yookassa_payments(merchant):
+    started = perf_counter()
     srv = YookassaService(Merchant.find_merchant(merchant))
     try:
         webhook: Webhook = srv.prepare_webhook()
     except ServiceError as err:
         if err.status_code == 400:
+            WEBHOOK_DURATION.labels('yookassa', 'ingest', 'rejected').observe(perf_counter() - started)
             return resp('Неопознанный IP адрес', 400)
         raise
-    try:
-        handle_webhook(webhook)
-    except Exception as err:
-        Logger.error(f"Unhandled webhook: {str(err)}\n{format_exc()}")
+
+    # уведомление только сохраняется, обработка выполняется задачей Celery
+    notification_id, outcome = store_notification(webhook, request.json)
+    if notification_id:
+        try:
+            handle_notification_task.delay(notification_id)
+        except Exception as err:
+            # уведомление сохранено, в очередь его поставит повторная отправка Yookassa
+            Logger.error(f"Не удалось поставить уведомление {notification_id} в очередь: {str(err)}\n{format_exc()}")
+            WEBHOOK_DURATION.labels('yookassa', 'ingest', 'enqueue_failed').observe(perf_counter() - started)
+            return resp('Уведомление не поставлено в очередь', 500)
+    WEBHOOK_DURATION.labels('yookassa', 'ingest', outcome).observe(perf_counter() - started)
 
     return resp('OK', 200)
 
 
+def store_notification(webhook: Webhook, payload: dict) -> Tuple[Optional[int], str]:
+    """
+    Сохранение сырого уведомления. Повторное уведомление (тот же платёж и событие) не сохраняется,
+    но если сохранённое уведомление ещё не обработано (например, не удалось поставить его в очередь),
+    оно ставится в очередь снова
+
+    :param webhook: атрибуты уведомления
+    :param payload: тело уведомления
+    :return: идентификатор уведомления, которое нужно поставить в очередь (None для обработанного повторного
+        уведомления), и результат приёма: stored, requeued или duplicate
+    """
+    requireMigrations(DbName.CORE, '0006_yookassa_notifications')
+    dedup_key = f'{webhook.payment_id}:{webhook.event}'
+    with Session(DbName.CORE) as ses:
+        notification_id = ses.execute(
+            insert(YookassaNotification).
+            values(dedup_key=dedup_key,
+                   payment_id=webhook.payment_id,
+                   event=webhook.event,
+                   merchant=webhook.merchant.value,
+                   transaction_id=webhook.transaction_id,
+                   payload=payload,
+                   received_date=getData()).
+            on_conflict_do_nothing(index_elements=[YookassaNotification.dedup_key]).
+            returning(YookassaNotification.notification_id)
+        ).scalar()
+        stored = None
+        if not notification_id:
+            stored = ses.query(YookassaNotification.notification_id, YookassaNotification.processed_date). \
+                filter_by(dedup_key=dedup_key).one_or_none()
+        ses.commit()
+
+    if notification_id:
+        return notification_id, 'stored'
+    if stored and stored.processed_date is None:
+        Logger.info(f'Повторное уведомление {webhook.event} по платежу {webhook.payment_id}: '
+                    f'уведомление {stored.notification_id} не обработано и ставится в очередь снова')
+        return stored.notification_id, 'requeued'
+    Logger.info(f'Повторное уведомление {webhook.event} по платежу {webhook.payment_id} пропущено')
+    return None, 'duplicate'
+
+
+@celery_app.task(autoretry_for=(ServiceError,), max_retries=3, retry_backoff=True)
+def handle_notification_task(notification_id: int, force: bool = False):
+    """
+    Обработка сохранённого уведомления Yookassa
+
+    :param notification_id: идентификатор уведомления
+    :param force: обработать повторно, даже если уведомление уже обработано
+    """
+    with Session(DbName.CORE) as ses:
+        # блокировка строки: повторно поставленное в очередь уведомление не обрабатывается одновременно
+        # в двух задачах, вторая увидит отметку об обработке
+        notification = ses.query(YookassaNotification).filter_by(notification_id=notification_id). \
+            with_for_update().one_or_none()
+        if not notification:
+            Logger.error(f'Уведомление {notification_id} не найдено')
+            return
+        if notification.processed_date and not force:
+            return
+
+        webhook = Webhook(transaction_id=notification.transaction_id,
+                          event=notification.event,
+                          merchant=Merchant.find_merchant(notification.merchant),
+                          payment_id=notification.payment_id)
+        attempts = (notification.attempts or 0) + 1
+        started = perf_counter()
+        try:
+            handle_webhook(webhook)
+        except ServiceError:
+            WEBHOOK_DURATION.labels('yookassa', 'process', 'retry').observe(perf_counter() - started)
+            ses.rollback()
+            ses.query(YookassaNotification).filter_by(notification_id=notification_id).\
+                update({'attempts': attempts, 'error': format_exc()})
+            ses.commit()
+            raise
+        except Exception as err:
+            WEBHOOK_DURATION.labels('yookassa', 'process', 'error').observe(perf_counter() - started)
+            Logger.error(f"Unhandled webhook: {str(err)}\n{format_exc()}")
+            ses.rollback()
+            ses.query(YookassaNotification).filter_by(notification_id=notification_id).\
+                update({'attempts': attempts, 'error': format_exc()})
+        else:
+            WEBHOOK_DURATION.labels('yookassa', 'process', 'processed').observe(perf_counter() - started)
+            ses.query(YookassaNotification).filter_by(notification_id=notification_id).\
+                update({'attempts': attempts, 'error': None, 'processed_date': getData()})
+        ses.commit()
+
+
+@yookassa_webhooks.cli.command('replay')
+@click.option('--since', type=click.DateTime(), help='Уведомления, полученные начиная с указанной даты')
+@click.option('--all', 'replay_all', is_flag=True, help='Включая уже обработанные уведомления')
+def replay_notifications(since: Optional[datetime], replay_all: bool):
+    """
+    Повторная обработка сохранённых уведомлений Yookassa
+    """
+    with Session(DbName.CORE) as ses:
+        sq = ses.query(YookassaNotification.notification_id).order_by(YookassaNotification.notification_id)
+        if since:
+            sq = sq.filter(YookassaNotification.received_date >= since)
+        if not replay_all:
+            sq = sq.filter(YookassaNotification.processed_date.is_(None))
+        notification_ids = [row.notification_id for row in sq]
+
+    for notification_id in notification_ids:
+        handle_notification_task.delay(notification_id, force=replay_all)
+    click.echo(f'Поставлено в очередь уведомлений: {len(notification_ids)}')
+
+
 @withSession(DbName.CORE)
 def handle_webhook(ses, webhook: Webhook):  # noqa: C901:
     """
@@ -48,7 +176,8 @@ def handle_webhook(ses, webhook: Webhook):  # noqa: C901:
 
     if webhook.event == WebhookNotificationEventType.PAYMENT_SUCCEEDED:
         # успешная оплата
-        trs: Transactions = ses.query(Transactions).filter_by(transaction_id=webhook.transaction_id).one_or_none()
+        trs: Transactions = query_profile(ses, Transactions, 'bare'). \
+            filter_by(transaction_id=webhook.transaction_id).one_or_none()
 
         if not trs:
             Logger.info(f'Транзакция {webhook.transaction_id} не найдена')
@@ -0,0 +1,76 @@
+"""
+Сравнение количества запросов и времени расчёта состояния оплаты акта:
+прежний многошаговый вариант set_certificate_status и агрегат certificate_payment_state.
+
+Запуск: python bench_certificate_status.py <certificate_code> <transaction_id> [повторов]
+"""
+import sys
+from datetime import datetime
+from time import perf_counter
+
+from sqlalchemy import event, and_
+
+from API.common import certificate_payment_state, FRANCHISE_DEPARTMENT_ID, MAX_DATE
+from DB import DbName, Session, getEngine
+from DB.models import Transactions, CertificateStatus, Franchise, ParticipantsXObject, AmoObjects, Report, getData
+from Services.common import TransactionTypeCode
+
+
+def legacy_payment_state(ses, certificate_code: str, transaction_id: str):
+    # чтения прежней реализации set_certificate_status
+    ses.query(Transactions.amount). \
+        filter(Transactions.entity_code == certificate_code,
+               Transactions.payment_type == 'billing',
+               Transactions.is_active.is_(True)).scalar()
+    closed_transactions = ses.query(Transactions). \
+        filter(Transactions.entity_code == certificate_code,
+               Transactions.transaction_type_code == TransactionTypeCode.CERTIFICATE_PAYMENT.value,
+               Transactions.payment_type.not_in(('billing', 'debt')),
+               Transactions.is_closed.is_(True),
+               Transactions.is_active.is_(True)).all()
+    sum(ct.amount for ct in closed_transactions)
+    ses.query(CertificateStatus). \
+        filter_by(certificate_code=certificate_code, date_end=getData(datetime.max)).first()
+    ses.query(Franchise.franchise_type, ParticipantsXObject.user_id). \
+        select_from(Transactions). \
+        join(ParticipantsXObject, and_(ParticipantsXObject.object_id == Transactions.object_id,
+                                       ParticipantsXObject.department_id == FRANCHISE_DEPARTMENT_ID,
+                                       ParticipantsXObject.date_end == MAX_DATE), isouter=True). \
+        join(AmoObjects, AmoObjects.objects_id == Transactions.object_id). \
+        join(Franchise, Franchise.franchise_id == AmoObjects.franchise_id). \
+        filter(Transactions.transaction_id == transaction_id).first()
+    ses.query(Report.certificate_num, Report.budgets_id). \
+        filter(Report.certificate_code == certificate_code).first()
+
+
+def measure(func, certificate_code: str, transaction_id: str, repeat: int) -> tuple:
+    statements = []
+    engine = getEngine(DbName.CORE)
+
+    def count(*_args):
+        statements.append(1)
+
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        started = perf_counter()
+        for _ in range(repeat):
+            with Session(DbName.CORE) as ses:
+                func(ses, certificate_code, transaction_id)
+        elapsed = perf_counter() - started
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+
+    return len(statements) / repeat, elapsed / repeat * 1000
+
+
+if __name__ == '__main__':
+    cert_code, trs_id = sys.argv[1], sys.argv[2]
+    repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+
+    with Session(DbName.CORE) as s:
+        payments = s.query(Transactions.transaction_id).filter(Transactions.entity_code == cert_code).count()
+    print(f'Акт {cert_code}: транзакций {payments}, повторов {repeats}')
+
+    for name, fn in (('legacy', legacy_payment_state), ('aggregate', certificate_payment_state)):
+        queries, latency = measure(fn, cert_code, trs_id, repeats)
+        print(f'{name:>10}: запросов {queries:.0f}, {latency:.2f} мс')
@@ -0,0 +1,41 @@
+"""
+Сравнение скорости выдачи номеров заказов: прежняя запись строки generator_id.order с фиксацией
+на каждый номер и выдача из блоков последовательности (SequenceBlockAllocator).
+
+Запуск: python bench_order_ids.py [количество номеров] [размер блока]
+"""
+import sys
+from time import perf_counter
+
+from DB import DbName, Session
+from DB.models import GeneratorOrder, ORDER_ID_PREFIX, ORDER_ID_SEQUENCE
+from DB.sequences import SequenceBlockAllocator
+
+
+def legacy_order_id(ses) -> str:
+    # прежняя реализация get_new_order_id
+    a = GeneratorOrder()
+    ses.add(a)
+    ses.commit()
+    return a.order_id
+
+
+def measure(func, count: int) -> tuple:
+    with Session(DbName.CORE) as ses:
+        started = perf_counter()
+        ids = [func(ses) for _ in range(count)]
+        elapsed = perf_counter() - started
+        ses.rollback()
+
+    return count / elapsed, len(set(ids)) == count
+
+
+if __name__ == '__main__':
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    block = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    allocator = SequenceBlockAllocator(ORDER_ID_SEQUENCE, block_size=block)
+    print(f'Номеров {total}, размер блока {block}')
+
+    for name, fn in (('legacy', legacy_order_id), ('block', lambda ses: f'{ORDER_ID_PREFIX}{allocator.next(ses)}')):
+        rate, unique = measure(fn, total)
+        print(f'{name:>10}: {rate:.0f} номеров/с, уникальны: {unique}')
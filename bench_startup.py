@@ -0,0 +1,50 @@
+"""
+Время запуска приложения: импорт модулей (python -X importtime) и создание приложения create_app.
+Каждый замер выполняется в отдельном процессе, как при запуске воркера.
+
+Запуск: python bench_startup.py [количество модулей в отчёте] [модуль приложения]
+"""
+import subprocess
+import sys
+
+STARTUP_CODE = '''
+from time import perf_counter
+started = perf_counter()
+from MainApp.appFactory import create_app
+imported = perf_counter()
+create_app(preload=False)
+print(f'{imported - started:.3f} {perf_counter() - imported:.3f}')
+'''
+
+
+def import_times(module: str) -> list:
+    result = subprocess.run((sys.executable, '-X', 'importtime', '-c', f'import {module}'),
+                            capture_output=True, text=True, check=True)
+    times = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times.append((name.strip(), int(self_us) / 1e6, int(cumulative_us) / 1e6))
+    return times
+
+
+def startup_time() -> tuple:
+    result = subprocess.run((sys.executable, '-c', STARTUP_CODE), capture_output=True, text=True, check=True)
+    imported, created = result.stdout.split()[-2:]
+    return float(imported), float(created)
+
+
+if __name__ == '__main__':
+    top = int(sys.argv[1]) if len(sys.argv) > 1 else 25
+    target = sys.argv[2] if len(sys.argv) > 2 else 'MainApp.appFactory'
+
+    modules = import_times(target)
+    print(f'Импорт {target}: модулей {len(modules)}')
+    print(f'{"модуль":<60} {"собств., с":>10} {"всего, с":>10}')
+    for name, own, cumulative in sorted(modules, key=lambda m: m[2], reverse=True)[:top]:
+        print(f'{name:<60} {own:>10.3f} {cumulative:>10.3f}')
+
+    imported, created = startup_time()
+    print(f'\nИмпорт приложения: {imported:.3f} с, create_app: {created:.3f} с')
@@ -0,0 +1,196 @@
+"""
+Запросы, выполняемые при загрузке транзакций с профилями DB.loading и обработчиками API и уведомлений.
+БД - sqlite в памяти, схемы модели присоединяются как отдельные базы
+"""
+import os
+import re
+from contextlib import contextmanager
+from datetime import datetime
+
+import pytest
+from flask import Flask
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+from yookassa.domain.notification import WebhookNotificationEventType
+
+import API.Yookassa
+import DB.connections
+import Webhooks.Yookassa
+from API.parsing_yookassa import check_transaction
+from DB import removeScopedSessions
+from DB.loading import query_profile
+from DB.models import Base, Transactions, TransactionStatus, TransactionStatusDimensions, TransactionTypes, Units, \
+    EstimateObjects
+from Services.Yookassa import Webhook
+
+TABLES = (Transactions, TransactionStatus, TransactionStatusDimensions, TransactionTypes, Units, EstimateObjects)
+
+# загрузка транзакции без связей: один запрос к таблице транзакций без соединений
+BARE_QUERY = ('business_entity.transaction', set())
+
+# запросы профиля: таблица FROM и присоединённые таблицы каждого запроса
+PROFILE_QUERIES = {
+    'bare': [
+        ('business_entity.transaction', set()),
+    ],
+    'with_status_history': [
+        ('business_entity.transaction', set()),
+        ('business_entity.transaction_status', {'dimension.transaction_status'}),
+    ],
+    'full': [
+        ('business_entity.transaction', {'dimension.transaction_type', 'public.unit',
+                                         'business_entity.estimate_objects'}),
+        ('business_entity.transaction_status', {'dimension.transaction_status'}),
+    ],
+}
+
+
+@pytest.fixture(scope='module')
+def engine():
+    # одно соединение: присоединённые базы в памяти существуют, пока оно открыто
+    engine = create_engine('sqlite://', poolclass=StaticPool)
+
+    @event.listens_for(engine, 'connect')
+    def attach_schemas(dbapi_connection, _):
+        for schema in ('business_entity', 'dimension', 'public'):
+            dbapi_connection.execute(f"ATTACH DATABASE ':memory:' AS {schema}")
+
+    Base.metadata.create_all(engine, tables=[model.__table__ for model in TABLES])
+    # значения по умолчанию модели (getData) - строки, sqlite принимает только datetime
+    now = datetime.now()
+    with Session(engine) as ses:
+        ses.add_all([Units(unit_code='RUB', unit_name='рубль'),
+                     TransactionTypes(transaction_type_code='PAYMENT', unit_code='RUB'),
+                     TransactionStatusDimensions(status_code='NEW'),
+                     TransactionStatusDimensions(status_code='PAID'),
+                     EstimateObjects(object_id=1),
+                     Transactions(transaction_id='П-1', transaction_type_code='PAYMENT', object_id=1,
+                                  created_date=now),
+                     Transactions(transaction_id='П-2', transaction_type_code='PAYMENT', object_id=1,
+                                  created_date=now, is_closed=False)])
+        ses.flush()
+        ses.add_all([TransactionStatus(transaction_id='П-1', status_code=status_code, start_date=now, end_date=now)
+                     for status_code in ('NEW', 'PAID')])
+        ses.commit()
+    return engine
+
+
+@pytest.fixture
+def db(engine, monkeypatch):
+    """
+    Реестр движков DB.connections, выдающий тестовую БД: обработчики получают сессии через Session/withSession
+    """
+    monkeypatch.setattr(DB.connections, '_engines', {})
+    monkeypatch.setattr(DB.connections, '_session_makers', {})
+    monkeypatch.setattr(DB.connections, '_checkout_stats', {})
+    monkeypatch.setattr(DB.connections, '_scoped_sessions', {})
+    monkeypatch.setattr(DB.connections, '_engines_pid', os.getpid())
+    monkeypatch.setattr(DB.connections, 'makeEngine', lambda db_name: engine)
+    # статистика выдачи соединений пулом StaticPool не поддерживается
+    monkeypatch.setattr(DB.connections, '_trackCheckouts', lambda db_name, engine: None)
+    return engine
+
+
+@contextmanager
+def captured_queries(engine):
+    """
+    Разбор запросов SELECT, выполненных в блоке
+
+    :param engine: движок БД
+    :return: список, в который после выхода из блока записываются таблица FROM и множество присоединённых таблиц
+        каждого запроса
+    """
+    statements, queries = [], []
+
+    def capture(_conn, _cursor, statement, *_args):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', capture)
+    try:
+        yield queries
+    finally:
+        event.remove(engine, 'before_cursor_execute', capture)
+
+    for statement in statements:
+        statement = statement.replace('"', '')
+        if not statement.lstrip().startswith('SELECT'):
+            continue
+        from_table = re.search(r'\bFROM (\w+\.\w+)', statement).group(1)
+        joins = set(re.findall(r'\bJOIN (\w+\.\w+)', statement))
+        queries.append((from_table, joins))
+
+
+def emitted_queries(engine, profile: str) -> list:
+    """
+    Загрузка транзакции с профилем и разбор выполненных запросов
+
+    :param engine: движок БД
+    :param profile: профиль загрузки
+    :return: таблица FROM и множество присоединённых таблиц каждого запроса
+    """
+    with captured_queries(engine) as queries:
+        with Session(engine) as ses:
+            trs = query_profile(ses, Transactions, profile).filter_by(transaction_id='П-1').one()
+            assert trs.transaction_id == 'П-1'
+    return queries
+
+
+@pytest.mark.parametrize('profile', PROFILE_QUERIES)
+def test_profile_queries(engine, profile):
+    assert emitted_queries(engine, profile) == PROFILE_QUERIES[profile]
+
+
+def test_check_transaction_loads_bare_transaction(db):
+    with captured_queries(db) as queries:
+        assert check_transaction('П-1').transaction_id == 'П-1'
+    assert queries == [BARE_QUERY]
+
+
+def test_payment_landing_loads_bare_transaction(db, monkeypatch):
+    monkeypatch.setattr(API.Yookassa, 'render_template', lambda _template, state, data: state.value)
+    app = Flask(__name__)
+    with captured_queries(db) as queries:
+        with app.test_request_context():
+            try:
+                response = API.Yookassa.YookassaPaymentLending().dispatch_request(transaction_id='П-1')
+            finally:
+                removeScopedSessions(commit=False)
+    assert response.get_data(as_text=True) == API.Yookassa.YookassaPaymentLending.States.READY_FOR_PAY.value
+    assert queries == [BARE_QUERY]
+
+
+def test_payment_delete_loads_bare_transaction(db):
+    app = Flask(__name__)
+    with captured_queries(db) as queries:
+        with app.test_request_context('/?orderNumber=П-2', method='DELETE'):
+            try:
+                response = API.Yookassa.YookassaPayments().dispatch_request()
+            finally:
+                removeScopedSessions(commit=False)
+    assert response.status_code == 200
+    assert queries == [BARE_QUERY]
+
+
+def test_webhook_loads_bare_transaction(db, monkeypatch):
+    # служба чеков не создаётся: обработка завершается после загрузки транзакции
+    monkeypatch.setattr(Webhooks.Yookassa.LifePayService, 'create_from_user_id', lambda _user_id: None)
+    webhook = Webhook(transaction_id='П-1',
+                      event=WebhookNotificationEventType.PAYMENT_SUCCEEDED,
+                      merchant=None,
+                      payment_id='payment-1')
+    with captured_queries(db) as queries:
+        Webhooks.Yookassa.handle_webhook(webhook)
+    assert queries == [BARE_QUERY]
+
+
+def test_bare_relationships_load_on_demand(engine):
+    with Session(engine) as ses:
+        trs = query_profile(ses, Transactions, 'bare').filter_by(transaction_id='П-1').one()
+        assert 'statuses' not in trs.__dict__ and 'type' not in trs.__dict__
+        assert {status.status_code for status in trs.statuses} == {'NEW', 'PAID'}
+
+
+def test_unknown_profile():
+    with pytest.raises(ValueError):
+        query_profile(None, Transactions, 'missing')